@@ -0,0 +1,917 @@
+import copy
+import cStringIO
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import compress
+from data import replace_raw_item_key, remove_structure, invert_structure, modify_save, export_items, import_items
+from data import dump_json, parse_changes
+from error import ERRNO
+from main import run_jobs
+from presents import unwrap_item, wrap_item, unwrap_items, wrap_items, rekey_items, store_items, wrap_player_data
+from presents import unwrap_player_data, unwrap_player_tree, save_structure
+from presents import pack_item_values, unpack_item_values
+from read import ReadBitstream, MessageView, read_protobuf, read_protobuf_value, decode_packed
+from read import read_varint, decode_varint, decode_packed_varints, decode_packed_numpy, numpy, numpy_packed_size
+from table import item_sizes, item_header_sizes, black_market_keys
+from tree import *
+from write import WriteBitstream, write_protobuf, write_protobuf_value, encode_packed, encode_varint
+
+# Best times of everything reported in this run, by name, for baselines
+results = {}
+
+
+def sample_payload(size, seed=0):
+    # Skewed towards small byte values like a decoded player protobuf
+    rng = random.Random(seed)
+    return "".join(chr(int(rng.expovariate(1 / 24.0)) & 0xff) for _ in xrange(size))
+
+
+def sample_items(count, seed=0):
+    # A read_protobuf style player holding only bank, backpack and weapon items
+    rng = random.Random(seed)
+    player = {}
+    for i in xrange(count):
+        is_weapon = i % 3 == 2
+        values = [rng.randrange(1 << size) for size in item_sizes[is_weapon]]
+        values[4] = values[5] = rng.randrange(1, 80)
+        entry = {1: [[2, wrap_item(is_weapon, values, rng.randrange(-1 << 31, 1 << 31))]]}
+        field = (53, 54, 41)[i % 3] if i % 7 else 41
+        player.setdefault(field, []).append([2, write_protobuf(entry)])
+    return player
+
+
+def synthetic_item(rng, is_weapon):
+    # An apply_structure style item, as unwrap_item_info gives. One in five
+    # is truncated, as items with fewer parts are in real saves.
+    sizes = item_sizes[is_weapon]
+    level = rng.randrange(1, 81)
+    item = {"is_weapon": is_weapon, "key": rng.randrange(-1 << 31, 1 << 31), "set": rng.randrange(1 << sizes[0])}
+    item["level"] = [level, level]
+    for i, (k, bits) in enumerate(item_header_sizes[is_weapon]):
+        value = rng.randrange(1 << sizes[1 + i])
+        item[k] = {"lib": value >> bits, "asset": value & ((1 << bits) - 1)}
+    bits = 10 + is_weapon
+    parts = []
+    for size in sizes[6:]:
+        value = rng.randrange(1 << size)
+        parts.append({"lib": value >> bits, "asset": value & ((1 << bits) - 1)})
+    if rng.random() < 0.2:
+        parts[-3:] = [None] * 3
+    item["parts"] = parts
+    return item
+
+
+def synthetic_player(seed=0, items=500, missions=80, challenges=200):
+    # An apply_structure style player for save_structure, the same for the
+    # same arguments. items are spread over the backpack, weapons and bank
+    # like a full character, with missions in each of three playthroughs.
+    rng = random.Random(seed)
+    level = rng.randrange(1, 81)
+
+    def name(prefix, i):
+        return "GD_%s.%s_%d" % (prefix, prefix, i)
+
+    player = {
+        "class": "GD_Assassin.Character.CharClass_Assassin",
+        "level": level,
+        "experience": rng.randrange(1 << 24),
+        "skill_points": rng.randrange(10),
+        "currency": [rng.randrange(1 << 31), rng.randrange(500), rng.randrange(1000), 0, rng.randrange(1000)],
+        "playthroughs_completed": rng.randrange(3),
+        "skills": [
+            {"name": name("Skill", i), "level": rng.randrange(6), "unknown3": 0, "unknown4": 0}
+            for i in xrange(30)
+        ],
+        "resources": [
+            {"resource": name("Resource", i), "pool": name("Pool", i), "amount": float(rng.randrange(1000)),
+             "level": rng.randrange(8)}
+            for i in xrange(8)
+        ],
+        "sizes": {"inventory": 39, "weapon_slots": 4, "weapon_slots_shown": 4},
+        "stats": [int(rng.expovariate(1 / 24.0)) & 0xff for _ in xrange(2000)],
+        "active_fast_travel": [name("FastTravel", i) for i in xrange(40)],
+        "last_fast_travel": name("FastTravel", 0),
+        "missions": [
+            {"playthrough": playthrough, "active": name("Mission", 0), "data": [
+                {"name": name("Mission", i), "status": rng.randrange(5), "is_from_dlc": 0, "dlc_id": 0,
+                 "unknown5": [0, 1], "unknown6": 0, "unknown7": [], "unknown8": 0, "unknown9": 0,
+                 "unknown10": 0, "level": rng.randrange(1, 81)}
+                for i in xrange(missions)
+            ]}
+            for playthrough in xrange(3)
+        ],
+        "appearance": {
+            "name": "Synthetic %d" % seed,
+            "color1": {"a": 255, "r": 10, "g": 20, "b": 30},
+            "color2": {"a": 255, "r": 40, "g": 50, "b": 60},
+            "color3": {"a": 255, "r": 70, "g": 80, "b": 90},
+        },
+        "save_game_id": seed,
+        "mission_number": missions,
+        "unlocks": [1],
+        "unlock_notifications": [],
+        "time_played": rng.randrange(1 << 20),
+        "save_timestamp": "20260101000000",
+        "game_stages": [
+            {"name": name("Region", i), "level": rng.randrange(1, 81), "is_from_dlc": 0, "dlc_id": 0,
+             "playthrough": rng.randrange(3)}
+            for i in xrange(40)
+        ],
+        "areas": [{"name": name("Area", i), "unknown2": 0} for i in xrange(40)],
+        "black_market": dict((k, rng.randrange(8)) for k in black_market_keys),
+        "active_mission": 0,
+        "challenges": [{"name": name("Challenge", i), "is_from_dlc": 0, "dlc_id": 0} for i in xrange(challenges)],
+        "explored_areas": [name("Area", i) for i in xrange(40)],
+        "active_playthrough": 0,
+        "bank_size": 16,
+    }
+    weapons = items // 4
+    bank = items // 4
+    player["weapons"] = [
+        {"data": synthetic_item(rng, 1), "slot": min(i + 1, 4) if i < 4 else 0, "star": 0, "unknown4": 0}
+        for i in xrange(weapons)
+    ]
+    player["items"] = [
+        {"data": synthetic_item(rng, 0), "unknown2": 1, "is_equipped": int(i < 4), "star": 0}
+        for i in xrange(items - weapons - bank)
+    ]
+    player["bank"] = [{"data": synthetic_item(rng, rng.randrange(2))} for _ in xrange(bank)]
+    return player
+
+
+def synthetic_save(seed=0, items=500, missions=80, challenges=200, level=1):
+    player = synthetic_player(seed, items, missions, challenges)
+    player = write_protobuf(remove_structure(player, invert_structure(save_structure)))
+    return wrap_player_data(player, level=level)
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def best_of_copies(repeat, func, player, *args):
+    # For functions that change the player, each run gets a fresh copy that
+    # is made outside the timing
+    best = None
+    for _ in xrange(repeat):
+        copied = copy.deepcopy(player)
+        start = time.time()
+        result = func(copied, *args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def report(name, elapsed, size):
+    results[name] = elapsed
+    print "%-32s %9.4fs %9.2f MB/s" % (name, elapsed, size / elapsed / 1e6)
+
+
+def report_items(name, elapsed, count):
+    results[name] = elapsed
+    print "%-32s %9.4fs %9.0f items/s" % (name, elapsed, count / elapsed)
+
+
+def walk_huffman_decompress(tree, bitstream, size):
+    # The original bit-at-a-time tree walk, kept as the reference decoder
+    output = ""
+    while len(output) < size:
+        node = tree
+        while 1:
+            b = bitstream.read_bit()
+            node = node[1][b]
+            if type(node[1]) is int:
+                output += chr(node[1])
+                break
+    return output
+
+
+def loop_copy_earlier_into(b, op, offset, n):
+    # The original slice-by-slice copy, kept as the reference, writing at op
+    # into a preallocated output like the decoder does
+    i = op - offset
+    end = op + n
+    while op < end:
+        chunk = b[i: min(op, i + end - op)]
+        b[op: op + len(chunk)] = chunk
+        i = i + len(chunk)
+        op = op + len(chunk)
+    return op
+
+
+def encode_payload(player):
+    bitstream = WriteBitstream()
+    tree = make_huffman_tree(player)
+    write_huffman_tree(tree, bitstream)
+    huffman_compress(make_encode_table(tree), player, bitstream)
+    return str(bitstream.getvalue())
+
+
+def decode_payload(decoder, data, size):
+    bitstream = ReadBitstream(data)
+    tree = read_huffman_tree(bitstream)
+    return decoder(tree, bitstream, size)
+
+
+def bench_huffman_decode(options):
+    size, repeat = options.size, options.repeat
+    player = sample_payload(size)
+    data = encode_payload(player)
+    walk_time, walked = best_of(repeat, decode_payload, walk_huffman_decompress, data, size)
+    table_time, decoded = best_of(repeat, decode_payload, huffman_decompress, data, size)
+    if walked != player or decoded != player:
+        raise AssertionError("Huffman decoders disagree")
+    report("huffman_decompress (walk)", walk_time, size)
+    report("huffman_decompress (table)", table_time, size)
+
+
+def bench_huffman_encode(options):
+    size, repeat = options.size, options.repeat
+    player = sample_payload(size)
+    tree = make_huffman_tree(player)
+    encoding = make_encode_table(tree)
+
+    def encode():
+        bitstream = WriteBitstream()
+        write_huffman_tree(tree, bitstream)
+        huffman_compress(encoding, player, bitstream)
+        return bitstream.getvalue()
+
+    elapsed, data = best_of(repeat, encode)
+    if decode_payload(huffman_decompress, str(data), size) != player:
+        raise AssertionError("Huffman encoding does not round trip")
+    report("huffman_compress", elapsed, size)
+
+
+def bench_huffman_tree(options):
+    size, repeat = options.size, options.repeat
+    player = sample_payload(size)
+    frequencies = count_frequencies(player)
+    build_time, tree = best_of(repeat, make_huffman_tree, player)
+    reuse_time, reused = best_of(repeat, make_huffman_tree, player, frequencies)
+    if make_encode_table(tree) != make_encode_table(reused):
+        raise AssertionError("Reused histogram built a different tree")
+    report("make_huffman_tree", build_time, size)
+    report("make_huffman_tree (histogram)", reuse_time, size)
+
+
+def lzo_corpus(options):
+    if not options.saves:
+        return [sample_payload(options.size)]
+    corpus = []
+    for path in options.saves:
+        data = open(path, "rb").read()
+        corpus.append(compress.decompress("\xf0" + data[20:]))
+    return corpus
+
+
+def bench_lzo(options):
+    corpus = lzo_corpus(options)
+    size = sum(map(len, corpus))
+    active = compress.backend
+    backends = compress.available_backends()
+    try:
+        packed = {}
+        for name in backends:
+            compress.use_backend(name)
+            elapsed, packed[name] = best_of(options.repeat, map, compress.compress, corpus)
+            report("compress (%s)" % name, elapsed, size)
+        for name in backends:
+            compress.use_backend(name)
+            for source, streams in packed.items():
+                elapsed, unpacked = best_of(options.repeat, map, compress.decompress, streams)
+                if unpacked != corpus:
+                    raise AssertionError("%s cannot decompress %s output" % (name, source))
+                report("decompress (%s from %s)" % (name, source), elapsed, size)
+    finally:
+        compress.use_backend(active)
+
+
+# Four literals followed by a 3 byte M2 match, reaching back to the start
+# of the output and then 1 and 96 bytes before it
+lzo_lookbehind_control = "\xf0\x00\x00\x00\x07\x15abcd\x4c\x00\x11\x00\x00"
+lzo_lookbehind_streams = [
+    "\xf0\x00\x00\x00\x07\x15abcd\x50\x00\x11\x00\x00",
+    "\xf0\x00\x00\x00\x07\x15abcd\x4c\x0c\x11\x00\x00",
+]
+
+
+def bench_lzo_backends(options):
+    # Every backend has to decompress what every other one compresses, the
+    # LZO streams of the saves given with -f and of synthetic saves, and
+    # reject every truncation of them and every match reaching back before
+    # the start of the output with ERRNO
+    backends = compress.available_backends()
+    if backends == ["python"]:
+        print >> sys.stderr, "WARNING: no native LZO backend is available, only python is checked"
+    streams = [open(path, "rb").read()[20:] for path in options.saves or []]
+    for items in (0, options.items):
+        streams.append(synthetic_save(0, items, options.missions, options.challenges)[20:])
+    active = compress.backend
+    try:
+        compress.use_backend("python")
+        corpus = [compress.decompress("\xf0" + stream) for stream in streams]
+        packed = {}
+        for name in backends:
+            compress.use_backend(name)
+            packed[name] = ["\xf0" + stream for stream in streams] + map(compress.compress, corpus)
+        truncations = 0
+        for name in backends:
+            compress.use_backend(name)
+            for source in backends:
+                for stream, expected in zip(packed[source], corpus + corpus):
+                    if compress.decompress(stream) != expected:
+                        raise AssertionError("%s does not decompress a %s stream" % (name, source))
+            for stream in packed[name]:
+                for cut in sorted(set(range(5, len(stream), max(1, len(stream) // 64)) + [len(stream) - 1])):
+                    try:
+                        compress.decompress(stream[: cut])
+                    except ERRNO:
+                        truncations = truncations + 1
+                        continue
+                    raise AssertionError("%s accepted a stream truncated to %d bytes" % (name, cut))
+            if compress.decompress(lzo_lookbehind_control) != "abcdabc":
+                raise AssertionError("%s does not decompress a match back to the start" % name)
+            for stream in lzo_lookbehind_streams:
+                try:
+                    compress.decompress(stream)
+                except ERRNO:
+                    continue
+                raise AssertionError("%s accepted a match before the start of the output" % name)
+        print "%-32s %d streams, %d truncations, %d lookbehinds" % (
+            "lzo backends (%s)" % ", ".join(backends), len(corpus) * 2, truncations, len(lzo_lookbehind_streams)
+        )
+    finally:
+        compress.use_backend(active)
+
+
+def bench_lzo_copy(options):
+    # Short-period runs such as zero padding decode as long overlapping copies
+    def copies(copy, offset):
+        count = options.size // 64
+        b = bytearray("x" * 256) + bytearray(count * 64)
+        op = 256
+        for _ in xrange(count):
+            op = copy(b, op, offset, 64)
+        return b
+
+    for offset in (1, 2, 3, 16, 256):
+        loop_time, looped = best_of(options.repeat, copies, loop_copy_earlier_into, offset)
+        fast_time, copied = best_of(options.repeat, copies, compress.copy_earlier_into, offset)
+        if looped != copied:
+            raise AssertionError("copy_earlier_into differs at offset %d" % offset)
+        report("slice loop copy (offset %d)" % offset, loop_time, len(copied))
+        report("copy_earlier_into (offset %d)" % offset, fast_time, len(copied))
+
+    rng = random.Random(0)
+    runs = "".join(chr(rng.randrange(4)) * rng.randrange(1, 300) for _ in xrange(options.size // 150))
+    stream = compress.python_compress(runs)
+    elapsed, unpacked = best_of(options.repeat, compress.python_decompress, stream)
+    if unpacked != runs:
+        raise AssertionError("Decompression of runs does not round trip")
+    report("python_decompress (runs)", elapsed, len(runs))
+
+
+def bench_lzo_levels(options):
+    corpus = lzo_corpus(options)
+    size = sum(map(len, corpus))
+    for level in xrange(1, 10):
+        elapsed, packed = best_of(options.repeat, map, lambda s: compress.compress(s, level), corpus)
+        if map(compress.decompress, packed) != corpus:
+            raise AssertionError("Level %d does not round trip" % level)
+        ratio = float(sum(map(len, packed))) / size
+        if level == 1:
+            fast_ratio = ratio
+        elif ratio > fast_ratio:
+            raise AssertionError("Level %d compresses worse than level 1, %.4f against %.4f" % (level, ratio, fast_ratio))
+        report("compress (level %d, ratio %.3f)" % (level, ratio), elapsed, size)
+
+
+def loop_item_levels(player, level):
+    # The per-item itemlevels loop that modify_save used before batching
+    for field_number in (53, 54):
+        for field in player[field_number]:
+            field_data = read_protobuf(field[1])
+            is_weapon, item, key = unwrap_item(field_data[1][0][1])
+            if item[4] > 1:
+                item = item[: 4] + [level, level] + item[6:]
+                field_data[1][0][1] = wrap_item(is_weapon, item, key)
+                field[1] = write_protobuf(field_data)
+    return player
+
+
+def batch_item_levels(player, level):
+    items = unwrap_items(player, (53, 54))
+    rows = [row for (row, levels) in enumerate(items["level"]) if levels[0] > 1]
+    for row in rows:
+        items["level"][row] = [level, level]
+    store_items(items, rows, wrap_items(items, rows))
+    return player
+
+
+def loop_export(player):
+    codes = []
+    for i in (41, 53, 54):
+        for field in player.get(i, []):
+            codes.append(replace_raw_item_key(read_protobuf(field[1])[1][0][1], 0))
+    return codes
+
+
+def batch_export(player):
+    return rekey_items(unwrap_items(player, unpack=False), 0)
+
+
+def loop_pack_item_values(is_weapon, values):
+    # The original byte-at-a-time packer, kept as the reference
+    i = 0
+    input_bytes = [0] * 32
+    for value, size in zip(values, item_sizes[is_weapon]):
+        if value is None:
+            break
+        j = i >> 3
+        value = value << (i & 7)
+        while value != 0:
+            input_bytes[j] |= value & 0xff
+            value = value >> 8
+            j = j + 1
+        i = i + size
+    if (i & 7) != 0:
+        value = 0xff << (i & 7)
+        input_bytes[i >> 3] |= (value & 0xff)
+    return "".join(map(chr, input_bytes[: (i + 7) >> 3]))
+
+
+def loop_unpack_item_values(is_weapon, data):
+    # The original byte-at-a-time unpacker, kept as the reference
+    i = 8
+    data = " " + data
+    values = []
+    end = len(data) * 8
+    for size in item_sizes[is_weapon]:
+        j = i + size
+        if j > end:
+            values.append(None)
+            continue
+        value = 0
+        for b in data[j >> 3: (i >> 3) - 1: -1]:
+            value = (value << 8) | ord(b)
+        values.append((value >> (i & 7)) & ~ (0xff << size))
+        i = j
+    return values
+
+
+def bench_item_values(options):
+    count = options.items
+    rng = random.Random(0)
+    items = []
+    for i in xrange(count):
+        is_weapon = i % 2
+        values = [rng.randrange(1 << size) for size in item_sizes[is_weapon]]
+        if i % 10 == 0:
+            # Truncated items end in None values
+            cut = rng.randrange(6, len(values))
+            values = values[: cut] + [None] * (len(values) - cut)
+        items.append((is_weapon, values))
+    packs = [(loop_pack_item_values, "loop"), (pack_item_values, "layout")]
+    unpacks = [(loop_unpack_item_values, "loop"), (unpack_item_values, "layout")]
+
+    results = []
+    for pack, name in packs:
+        elapsed, packed = best_of(options.repeat, lambda: [pack(w, v) for (w, v) in items])
+        report_items("pack_item_values (%s)" % name, elapsed, count)
+        results.append(packed)
+    if results[0] != results[1]:
+        raise AssertionError("pack_item_values differs from the byte loop")
+
+    data = [(w, d) for ((w, _), d) in zip(items, results[0])]
+    results = []
+    for unpack, name in unpacks:
+        elapsed, unpacked = best_of(options.repeat, lambda: [unpack(w, d) for (w, d) in data])
+        report_items("unpack_item_values (%s)" % name, elapsed, count)
+        results.append(unpacked)
+    if results[0] != results[1]:
+        raise AssertionError("unpack_item_values differs from the byte loop")
+
+
+def bench_items(options):
+    count = options.items
+    player = sample_items(count)
+    loop_time, looped = best_of_copies(options.repeat, loop_item_levels, player, 50)
+    batch_time, batched = best_of_copies(options.repeat, batch_item_levels, player, 50)
+    if looped != batched:
+        raise AssertionError("Batched itemlevels differs from the item loop")
+    report_items("itemlevels (loop)", loop_time, count)
+    report_items("itemlevels (batch)", batch_time, count)
+
+    loop_time, looped = best_of(options.repeat, loop_export, player)
+    batch_time, batched = best_of(options.repeat, batch_export, player)
+    if looped != batched:
+        raise AssertionError("Batched export differs from the item loop")
+    report_items("export (loop)", loop_time, count)
+    report_items("export (batch)", batch_time, count)
+
+
+def bench_protobuf(options):
+    # Changing one value of a player the size of a full inventory
+    data = write_protobuf(sample_items(options.items))
+
+    def eager():
+        player = read_protobuf(data)
+        player[2] = [[0, 50]]
+        return write_protobuf(player)
+
+    def lazy():
+        player = MessageView(data)
+        player[2] = [[0, 50]]
+        return player.tobytes()
+
+    view = MessageView(data)
+
+    def splice():
+        # Serializing an already scanned view only copies the unchanged bytes
+        view[2] = [[0, 50]]
+        return view.tobytes()
+
+    eager_time, written = best_of(options.repeat, eager)
+    lazy_time, spliced = best_of(options.repeat, lazy)
+    splice_time, respliced = best_of(options.repeat, splice)
+    if written != spliced or written != respliced:
+        raise AssertionError("MessageView differs from write_protobuf")
+    report("read_protobuf/write_protobuf", eager_time, len(data))
+    report("MessageView", lazy_time, len(data))
+    report("MessageView.tobytes", splice_time, len(data))
+
+
+def loop_decode_packed(data, wire_type):
+    # The original file object decoder, kept as the reference
+    b = cStringIO.StringIO(data)
+    values = []
+    while b.tell() < len(data):
+        values.append(read_protobuf_value(b, wire_type))
+    return values
+
+
+def loop_write_varint(b, value):
+    # The original byte at a time varint writer, kept as the reference
+    while value > 0x7f:
+        b.write(chr(0x80 | (value & 0x7f)))
+        value = value >> 7
+    b.write(chr(value))
+
+
+def loop_encode_packed(values, wire_type):
+    # The original file object encoder, kept as the reference
+    b = cStringIO.StringIO()
+    for value in values:
+        if wire_type == 0:
+            loop_write_varint(b, value)
+        elif wire_type == 2:
+            loop_write_varint(b, len(value))
+            b.write(value)
+        else:
+            write_protobuf_value(b, wire_type, value)
+    return b.getvalue()
+
+
+def loop_write_protobuf(message):
+    # write_protobuf for a message of plain values, built from the references
+    b = cStringIO.StringIO()
+    for key, entries in sorted(message.items()):
+        for wire_type, value in entries:
+            loop_write_varint(b, (key << 3) | wire_type)
+            b.write(loop_encode_packed([value], wire_type))
+    return b.getvalue()
+
+
+def bench_varint(options):
+    rng = random.Random(0)
+    count = options.size // 4
+    samples = [
+        ("small", 0, [rng.randrange(0x80) for _ in xrange(count)]),
+        ("mixed", 0, [rng.randrange(1 << rng.randrange(1, 64)) for _ in xrange(count)]),
+        ("fixed32", 5, [rng.randrange(1 << 32) for _ in xrange(count)]),
+    ]
+    for name, wire_type, values in samples:
+        loop_time, looped = best_of(options.repeat, loop_encode_packed, values, wire_type)
+        fast_time, data = best_of(options.repeat, encode_packed, values, wire_type)
+        if looped != data:
+            raise AssertionError("encode_packed differs for %s values" % name)
+        report("packed encode loop (%s)" % name, loop_time, len(data))
+        report("encode_packed (%s)" % name, fast_time, len(data))
+        loop_time, looped = best_of(options.repeat, loop_decode_packed, data, wire_type)
+        fast_time, decoded = best_of(options.repeat, decode_packed, data, wire_type)
+        if looped != values or decoded != values:
+            raise AssertionError("decode_packed differs for %s values" % name)
+        report("packed decode loop (%s)" % name, loop_time, len(data))
+        report("decode_packed (%s)" % name, fast_time, len(data))
+
+
+def bench_varint_check(options):
+    # Random values of every wire type, with varints of every length up to
+    # the 10 bytes of 64 bit values, have to encode and decode as the
+    # original read_varint and write_varint do, one at a time, packed and in
+    # messages. decode_packed_numpy is called directly, as decode_packed only
+    # uses it for long fields.
+    if numpy is None:
+        print >> sys.stderr, "WARNING: NumPy is not installed, decode_packed_numpy is not checked"
+    rng = random.Random(options.seed)
+    edges = [0, 0x7f, 0x80, (1 << 56) - 1, 1 << 56, (1 << 63) - 1, 1 << 63, (1 << 64) - 1]
+    counts = dict.fromkeys((0, 1, 2, 5), 0)
+
+    def check_packed(name, values, wire_type):
+        data = loop_encode_packed(values, wire_type)
+        if encode_packed(values, wire_type) != data:
+            raise AssertionError("encode_packed differs for %s values" % name)
+        if loop_decode_packed(data, wire_type) != values or decode_packed(data, wire_type) != values:
+            raise AssertionError("decode_packed differs for %s values" % name)
+        counts[wire_type] = counts[wire_type] + len(values)
+        if wire_type != 0:
+            return
+        decoders = [decode_packed_varints] + ([decode_packed_numpy] if numpy is not None else [])
+        for decode in decoders:
+            if decode(data) != values:
+                raise AssertionError("%s differs for %s values" % (decode.__name__, name))
+            if values and values[-1] > 0x7f:
+                try:
+                    decode(data[: -1])
+                except ERRNO:
+                    continue
+                raise AssertionError("%s accepted a truncated varint" % decode.__name__)
+
+    for round in xrange(200):
+        # Up to 63 bits every varint fits the NumPy path, past that it falls back
+        bits = 63 if round % 2 else 64
+        varints = [rng.randrange(1 << rng.randrange(1, bits + 1)) for _ in xrange(rng.randrange(64))]
+        varints.extend(value for value in edges if value < (1 << bits) and rng.randrange(2))
+        rng.shuffle(varints)
+        samples = {
+            0: varints,
+            1: [rng.randrange(1 << 64) for _ in xrange(rng.randrange(16))],
+            2: ["".join(chr(rng.randrange(256)) for _ in xrange(rng.choice((0, 1, 127, 128, 300)))) for _ in xrange(4)],
+            5: [rng.randrange(1 << 32) for _ in xrange(rng.randrange(16))],
+        }
+        for wire_type, values in sorted(samples.items()):
+            check_packed("wire type %d" % wire_type, values, wire_type)
+        for value in varints:
+            encoded = loop_encode_packed([value], 0)
+            if encode_varint(value) != encoded or decode_varint(encoded, 0) != (value, len(encoded)):
+                raise AssertionError("varint %d differs" % value)
+            if read_varint(cStringIO.StringIO(encoded)) != value:
+                raise AssertionError("read_varint differs for %d" % value)
+        message = {}
+        for field_number in rng.sample(xrange(1, 3000), 8):
+            wire_type = rng.choice(sorted(samples))
+            if samples[wire_type]:
+                entries = rng.randrange(1, 3)
+                message[field_number] = [[wire_type, rng.choice(samples[wire_type])] for _ in xrange(entries)]
+        data = write_protobuf(message)
+        if data != loop_write_protobuf(message):
+            raise AssertionError("write_protobuf differs")
+        view = MessageView(data)
+        if read_protobuf(data) != message or dict((key, view[key]) for key in view) != message:
+            raise AssertionError("read_protobuf differs")
+    # Fields long enough for decode_packed to hand them to NumPy itself
+    for bits in (7, 63, 64):
+        values = [rng.randrange(1 << rng.randrange(1, bits + 1)) for _ in xrange(numpy_packed_size)]
+        check_packed("%d bit" % bits, values, 0)
+    print "%-32s %s values of wire types 0, 1, 2, 5, NumPy %s" % (
+        "varint check", "/".join(str(counts[wire_type]) for wire_type in sorted(counts)),
+        "checked" if numpy is not None else "NOT CHECKED"
+    )
+
+
+def bench_parallel(options):
+    # Decodes a directory of saves to JSON with 1 up to --jobs processes
+    directory = tempfile.mkdtemp()
+    try:
+        jobs = []
+        size = 0
+        for i in xrange(options.saves_count):
+            path = os.path.join(directory, "%d.sav" % i)
+            data = synthetic_save(i, options.items, options.missions, options.challenges)
+            open(path, "wb").write(data)
+            size = size + len(data)
+            job_options = optparse.Values({"parse": True})
+            jobs.append(("json", path, path + ".json", job_options))
+        processes = 1
+        while 1:
+            start = time.time()
+            outcomes = [result for (_, result) in run_jobs(jobs, processes)]
+            elapsed = time.time() - start
+            if not all(ok for (ok, _, _) in outcomes):
+                raise AssertionError("Parallel decode failed: %r" % (outcomes,))
+            name = "decode to JSON (%d processes)" % processes
+            results[name] = elapsed
+            print "%-32s %9.4fs %9.1f saves/s %6.2f MB/s" % (name, elapsed, len(jobs) / elapsed, size / elapsed / 1e6)
+            if processes >= options.jobs:
+                break
+            processes = min(processes * 2, options.jobs)
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_bitstream(options):
+    # Reading and writing a mix of the widths item and tree codes use
+    rng = random.Random(0)
+    widths = [rng.choice((1, 3, 7, 8, 13, 17)) for _ in xrange(options.size // 2)]
+    values = [rng.randrange(1 << n) for n in widths]
+    pairs = zip(values, widths)
+
+    def write():
+        bitstream = WriteBitstream()
+        for value, n in pairs:
+            bitstream.write_bits(value, n)
+        return str(bitstream.getvalue())
+
+    def read(data):
+        bitstream = ReadBitstream(data)
+        return [bitstream.read_bits(n) for n in widths]
+
+    write_time, data = best_of(options.repeat, write)
+    read_time, read_values = best_of(options.repeat, read, data)
+    if read_values != values:
+        raise AssertionError("Bitstream does not round trip")
+    report("WriteBitstream.write_bits", write_time, len(data))
+    report("ReadBitstream.read_bits", read_time, len(data))
+
+
+def bench_saves(options):
+    # The whole codec and the save operations on a synthetic save
+    data = synthetic_save(0, options.items, options.missions, options.challenges)
+    player = unwrap_player_data(data)
+    elapsed, unwrapped = best_of(options.repeat, unwrap_player_data, data)
+    if unwrapped != player:
+        raise AssertionError("unwrap_player_data is not deterministic")
+    report("unwrap_player_data", elapsed, len(player))
+    elapsed, wrapped = best_of(options.repeat, wrap_player_data, player)
+    if unwrap_player_data(wrapped) != player:
+        raise AssertionError("wrap_player_data does not round trip")
+    report("wrap_player_data", elapsed, len(player))
+    tree = unwrap_player_tree(data)[1]
+    elapsed, wrapped = best_of(options.repeat, lambda: wrap_player_data(player, tree=tree))
+    if unwrap_player_data(wrapped) != player:
+        raise AssertionError("wrap_player_data with the save's tree does not round trip")
+    report("wrap_player_data (save's tree)", elapsed, len(player))
+
+    changes = parse_changes("itemlevels=50,level=50,money=99999999")
+    elapsed, _ = best_of(options.repeat, modify_save, data, changes)
+    report("modify_save", elapsed, len(player))
+    output = cStringIO.StringIO()
+    elapsed, _ = best_of(options.repeat, lambda: export_items(data, cStringIO.StringIO()))
+    export_items(data, output)
+    codes = output.getvalue()
+    report("export_items", elapsed, len(player))
+    empty = synthetic_save(1, 0, options.missions, options.challenges)
+    elapsed, imported = best_of(options.repeat, import_items, empty, codes)
+    report("import_items", elapsed, len(player))
+    elapsed, _ = best_of(
+        options.repeat, lambda: dump_json(MessageView(player), cStringIO.StringIO(), save_structure)
+    )
+    report("dump_json (parsed)", elapsed, len(player))
+
+
+def write_baseline(path, options):
+    baseline = {
+        "options": {
+            "size": options.size, "items": options.items, "missions": options.missions,
+            "challenges": options.challenges, "saves": options.saves
+        },
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=4, sort_keys=True)
+
+
+def compare_baseline(path, options):
+    # Prints every result against the baseline, and returns the names of
+    # those more than options.threshold slower
+    baseline = json.load(open(path))
+    for k, v in sorted(baseline["options"].items()):
+        if getattr(options, k) != v:
+            print >> sys.stderr, "Warning: baseline was run with %s=%r, not %r" % (k, v, getattr(options, k))
+    regressions = []
+    print
+    print "%-32s %10s %10s %8s" % ("compared to " + path, "baseline", "now", "change")
+    for name in sorted(results):
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        change = results[name] / before - 1
+        flag = ""
+        if change > options.threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print "%-32s %9.4fs %9.4fs %+7.1f%%%s" % (name, before, results[name], change * 100, flag)
+    return regressions
+
+
+benchmarks = {
+    "bitstream": bench_bitstream,
+    "huffman_decode": bench_huffman_decode,
+    "huffman_encode": bench_huffman_encode,
+    "huffman_tree": bench_huffman_tree,
+    "item_values": bench_item_values,
+    "items": bench_items,
+    "lzo": bench_lzo,
+    "lzo_backends": bench_lzo_backends,
+    "lzo_copy": bench_lzo_copy,
+    "lzo_levels": bench_lzo_levels,
+    "parallel": bench_parallel,
+    "protobuf": bench_protobuf,
+    "saves": bench_saves,
+    "varint": bench_varint,
+    "varint_check": bench_varint_check,
+}
+
+
+def main():
+    p = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    p.add_option(
+        "-s", "--size", type="int", default=1 << 20,
+        help="payload size in bytes"
+    )
+    p.add_option(
+        "-r", "--repeat", type="int", default=3,
+        help="number of runs to take the best time from"
+    )
+    p.add_option(
+        "-n", "--items", type="int", default=500,
+        help="number of items in synthetic players"
+    )
+    p.add_option(
+        "--missions", type="int", default=80,
+        help="number of missions per playthrough in synthetic saves"
+    )
+    p.add_option(
+        "--challenges", type="int", default=200,
+        help="number of challenges in synthetic saves"
+    )
+    p.add_option(
+        "-j", "--jobs", type="int", default=multiprocessing.cpu_count(),
+        help="largest number of processes for the parallel benchmark"
+    )
+    p.add_option(
+        "-c", "--saves", dest="saves_count", type="int", default=32,
+        help="number of synthetic saves for the parallel benchmark"
+    )
+    p.add_option(
+        "-f", "--save", metavar="FILENAME", dest="saves", action="append",
+        help="use a save game as input instead of synthetic data, may be repeated"
+    )
+    p.add_option(
+        "-g", "--generate", metavar="FILENAME",
+        help="write a synthetic save game with --items, --missions and --challenges, and --seed, then exit"
+    )
+    p.add_option(
+        "--seed", type="int", default=0,
+        help="seed for --generate and the random values of varint_check"
+    )
+    p.add_option(
+        "-o", "--save-baseline", metavar="FILENAME",
+        help="write the results to a JSON baseline"
+    )
+    p.add_option(
+        "-b", "--baseline", metavar="FILENAME",
+        help="compare the results to a JSON baseline and exit with 1 on any regression"
+    )
+    p.add_option(
+        "-t", "--threshold", type="float", default=0.1,
+        help="slowdown against the baseline that counts as a regression, 0.1 by default"
+    )
+    options, args = p.parse_args()
+    if options.generate:
+        data = synthetic_save(options.seed, options.items, options.missions, options.challenges)
+        open(options.generate, "wb").write(data)
+        return
+    for name in args or sorted(benchmarks):
+        if name not in benchmarks:
+            print >> sys.stderr, "Unknown benchmark " + name
+            continue
+        benchmarks[name](options)
+    if options.save_baseline:
+        write_baseline(options.save_baseline, options)
+    if options.baseline:
+        regressions = compare_baseline(options.baseline, options)
+        if regressions:
+            print >> sys.stderr, "%d regressions: %s" % (len(regressions), ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import binascii
+import hashlib
+import os
+import tempfile
+
+
+class PlayerCache(object):
+    # Decoded players keyed by the SHA1 their save starts with. Recently
+    # used players are kept in memory, in a young and an old generation like
+    # the keystream cache, each holding up to half of memory_size bytes. With
+    # a directory they are kept on disk as well, each file holding the SHA1
+    # of the player followed by the player, and the least recently used
+    # files go once the directory holds more than disk_size bytes. Files
+    # that fail their check are removed and count as misses.
+
+    def __init__(self, directory=None, memory_size=64 << 20, disk_size=1 << 30):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.young = {}
+        self.old = {}
+        self.young_size = 0
+        self.disk_used = None
+        self.hits = 0
+        self.misses = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        player = self.young.get(key)
+        if player is None:
+            player = self.old.get(key)
+            if player is None and self.directory is not None:
+                player = self.load(key)
+            if player is None:
+                self.misses = self.misses + 1
+                return None
+            self.remember(key, player)
+        self.hits = self.hits + 1
+        return player
+
+    def put(self, key, player):
+        self.remember(key, player)
+        if self.directory is not None:
+            self.store(key, player)
+
+    def remember(self, key, player):
+        limit = self.memory_size // 2
+        if len(player) > limit:
+            return
+        if self.young_size + len(player) > limit:
+            self.old = self.young
+            self.young = {}
+            self.young_size = 0
+        self.young[key] = player
+        self.young_size = self.young_size + len(player)
+
+    def path(self, key):
+        return os.path.join(self.directory, binascii.hexlify(key))
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        player = data[20:]
+        if hashlib.sha1(player).digest() != data[: 20]:
+            self.remove(path)
+            return None
+        # The modification time orders files for eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return player
+
+    def store(self, key, player):
+        # Written to a temporary file and renamed so that other processes
+        # sharing the directory never see part of a file
+        fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(hashlib.sha1(player).digest())
+            f.write(player)
+        os.rename(temp, self.path(key))
+        if self.disk_used is not None:
+            self.disk_used = self.disk_used + 20 + len(player)
+        if self.disk_used is None or self.disk_used > self.disk_size:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        used = sum(size for (_, size, _) in entries)
+        for mtime, size, path in entries:
+            if used <= self.disk_size:
+                break
+            self.remove(path)
+            used = used - size
+        self.disk_used = used
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,60 @@
+import httplib
+import json
+import time
+import urllib
+
+from error import ERRNO
+
+
+class ServiceClient(object):
+    # Calls a service.py server. Requests the server is too busy for are
+    # retried after the delay it asks for, up to retries times.
+
+    def __init__(self, host="127.0.0.1", port=8642, timeout=60, retries=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+
+    def request(self, method, path, body=None, params=None):
+        if params:
+            path = path + "?" + urllib.urlencode(params)
+        attempt = 0
+        while 1:
+            connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                connection.request(method, path, body)
+                response = connection.getresponse()
+                data = response.read()
+            finally:
+                connection.close()
+            if response.status == 200:
+                return data
+            elif response.status == 503 and attempt < self.retries:
+                attempt = attempt + 1
+                time.sleep(float(response.getheader("Retry-After", 1)))
+                continue
+            raise ERRNO("Service error %d: %s" % (response.status, data))
+
+    def status(self):
+        return json.loads(self.request("GET", "/status"))
+
+    def unwrap_player_data(self, data):
+        return self.request("POST", "/unwrap", data)
+
+    def wrap_player_data(self, player, level=1):
+        return self.request("POST", "/wrap", player, {"level": level})
+
+    def modify_save(self, data, changes, level=1):
+        # changes is a dict as for data.modify_save, or the comma separated
+        # string main.py takes
+        if isinstance(changes, dict):
+            changes = ",".join(k if v is None else "%s=%s" % (k, v) for (k, v) in sorted(changes.items()))
+        return self.request("POST", "/modify", data, {"changes": changes, "level": level})
+
+    def export_items(self, data):
+        return self.request("POST", "/export", data)
+
+    def import_items(self, data, codelist, level=1):
+        body = json.dumps({"save": data.encode("base64"), "codes": codelist})
+        return self.request("POST", "/import", body, {"level": level})
@@ -1,8 +1,185 @@
-from data import copy_earlier, expand_zeroes
+import ctypes
+import ctypes.util
+import struct
+
+from error import ERRNO
 from table import clz_table
 
+# Native implementations are tried in this order before the Python port
+native_backends = ("lzo", "liblzo2")
+
+backend = None
+backend_functions = None
+
+# Hash chain depth and the match length that ends a search for the
+# higher compression levels; level 1 is the LZO1X-1 matcher
+compress_levels = {
+    2: (4, 16),
+    3: (8, 32),
+    4: (16, 64),
+    5: (32, 128),
+    6: (64, 128),
+    7: (256, 256),
+    8: (1024, 1024),
+    9: (4096, 4096),
+}
+
+
+# No LZO1X stream writes more than 255 bytes for each of its own, which is
+# what every zero byte extending a match's length adds, and no save comes
+# near the cap. Size fields past either are rejected before anything is
+# allocated for them.
+max_ratio = 256
+max_decompressed_size = 256 << 20
+
+
+def compress(s, level=1):
+    if level <= 1:
+        return backend_functions[0](s)
+    max_chain, nice_length = compress_levels[min(level, 9)]
+    packed = python_compress_best(s, max_chain, nice_length)
+    # The searches can still lose to level 1 on data with little to find
+    fast = backend_functions[0](s)
+    return fast if len(fast) < len(packed) else packed
+
+
+def decompress(s):
+    dst = bytearray(decompressed_size(s))
+    check_decompressed_size(len(dst), decompress_into(s, dst))
+    return str(dst)
+
+
+def decompress_into(s, dst, start=1):
+    # s[start:] holds the big-endian uncompressed size followed by the LZO
+    # stream, the default skips the 0xf0 marker written by compress(). The
+    # output is written to the start of the bytearray dst and its length is
+    # returned.
+    return backend_functions[1](s, dst, start)
+
+
+def decompressed_size(s, start=1):
+    size = struct.unpack_from(">I", s, start)[0]
+    if size > max_decompressed_size or size > (len(s) - start - 4) * max_ratio:
+        raise ERRNO("Invalid LZO size %d for a %d byte stream" % (size, len(s) - start - 4))
+    return size
+
+
+def check_decompressed_size(size, written):
+    # A stream has to write exactly the size its header gives
+    if written != size:
+        raise ERRNO("LZO stream holds %d bytes, not %d" % (written, size))
+
+
+def available_backends():
+    names = []
+    for name in native_backends + ("python",):
+        try:
+            backend_loaders[name]()
+        except (ImportError, OSError):
+            continue
+        names.append(name)
+    return names
+
+
+def use_backend(name=None):
+    global backend, backend_functions
+    if name is None:
+        for name in native_backends:
+            try:
+                backend_functions = backend_loaders[name]()
+            except (ImportError, OSError):
+                continue
+            backend = name
+            return backend
+        name = "python"
+    if name not in backend_loaders:
+        raise ERRNO("Unknown LZO backend " + repr(name))
+    backend_functions = backend_loaders[name]()
+    backend = name
+    return backend
+
+
+def as_bytes(s):
+    # str() of a memoryview is its repr in Python 2
+    if type(s) is memoryview:
+        return s.tobytes()
+    return str(s)
 
-def compress(s):
+
+def load_python_backend():
+    return python_compress, python_decompress_into
+
+
+def load_lzo_module():
+    # The python-lzo C extension uses the same 0xf0 + size header as the saves
+    import lzo
+
+    def lzo_compress(s):
+        return lzo.compress(as_bytes(s), 1)
+
+    def lzo_decompress_into(s, dst, start=1):
+        try:
+            data = lzo.decompress("\xf0" + as_bytes(s[start:]))
+        except lzo.error as e:
+            raise ERRNO("LZO decompression failed: " + str(e))
+        dst[: len(data)] = data
+        return len(data)
+
+    return lzo_compress, lzo_decompress_into
+
+
+def load_liblzo2():
+    path = ctypes.util.find_library("lzo2")
+    if path is None:
+        raise ImportError("liblzo2 not found")
+    lib = ctypes.CDLL(path)
+    # Passing -1 for the type sizes skips lzo_init's ABI checks
+    if getattr(lib, "__lzo_init_v2")(0x2000, -1, -1, -1, -1, -1, -1, -1, -1, -1) != 0:
+        raise ImportError("liblzo2 failed to initialise")
+
+    size_p = ctypes.POINTER(ctypes.c_size_t)
+    lib.lzo1x_1_compress.argtypes = (ctypes.c_char_p, ctypes.c_size_t, ctypes.c_char_p, size_p, ctypes.c_void_p)
+    lib.lzo1x_decompress_safe.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, size_p, ctypes.c_void_p)
+    work_size = 16384 * ctypes.sizeof(ctypes.c_void_p)
+
+    def liblzo2_compress(s):
+        s = as_bytes(s)
+        dst = ctypes.create_string_buffer(len(s) + (len(s) >> 4) + 64 + 3)
+        dst_len = ctypes.c_size_t(len(dst))
+        work = ctypes.create_string_buffer(work_size)
+        if lib.lzo1x_1_compress(s, len(s), dst, ctypes.byref(dst_len), work) != 0:
+            raise ERRNO("LZO compression failed")
+        return struct.pack(">BI", 240, len(s)) + dst.raw[: dst_len.value]
+
+    def liblzo2_decompress_into(s, dst, start=1):
+        # Both buffers are handed to liblzo2 in place when they allow it
+        if type(s) is bytearray:
+            src = (ctypes.c_char * len(s)).from_buffer(s)
+            address = ctypes.addressof(src)
+        else:
+            src = ctypes.c_char_p(as_bytes(s))
+            address = ctypes.cast(src, ctypes.c_void_p).value
+        out = (ctypes.c_char * len(dst)).from_buffer(dst)
+        dst_len = ctypes.c_size_t(len(dst))
+        # The stream follows the marker byte and the 4 byte size
+        in_len = len(s) - start - 4
+        if in_len < 0:
+            raise ERRNO("LZO decompression failed")
+        if lib.lzo1x_decompress_safe(address + start + 4, in_len, out, ctypes.byref(dst_len), None) != 0:
+            raise ERRNO("LZO decompression failed")
+        return dst_len.value
+
+    return liblzo2_compress, liblzo2_decompress_into
+
+
+backend_loaders = {
+    "lzo": load_lzo_module,
+    "liblzo2": load_liblzo2,
+    "python": load_python_backend,
+}
+
+
+def python_compress(s):
     src = bytearray(s)
     dst = bytearray()
 
@@ -24,21 +201,7 @@ def compress(s):
     t += length
 
     if t > 0:
-        ii = len(s) - t
-
-        if len(dst) == 5 and t <= 238:
-            dst.append(17 + t)
-        elif t <= 3:
-            dst[-2] |= t
-        elif t <= 18:
-            dst.append(t - 3)
-        else:
-            tt = t - 18
-            dst.append(0)
-            n, tt = divmod(tt, 255)
-            dst.extend("\x00" * n)
-            dst.append(tt)
-        dst.extend(src[ii: ii + t])
+        write_literals(dst, src, len(s) - t, t)
 
     dst.append(16 | 1)
     dst.append(0)
@@ -47,6 +210,138 @@ def compress(s):
     return str(dst)
 
 
+def python_compress_best(s, max_chain, nice_length):
+    # Hash chains over 3 byte prefixes with one step of lazy matching. Only
+    # M2, M3 and M4 matches are written, the same subset compress_core uses.
+    s = as_bytes(s)
+    src = bytearray(s)
+    dst = bytearray(struct.pack(">BI", 240, len(s)))
+    length = len(s)
+    last = length - 3
+    head = {}
+    chain = [-1] * length
+    inserted = 0
+
+    ii = 0
+    ip = 0
+    while ip <= last:
+        for i in xrange(inserted, ip):
+            key = s[i: i + 3]
+            chain[i] = head.get(key, -1)
+            head[key] = i
+        inserted = ip
+        m_len, m_off = find_match(s, head, chain, ip, max_chain, nice_length)
+        while m_len != 0 and m_len < nice_length and ip < last:
+            key = s[ip: ip + 3]
+            chain[ip] = head.get(key, -1)
+            head[key] = ip
+            inserted = ip + 1
+            n_len, n_off = find_match(s, head, chain, ip + 1, max_chain, nice_length)
+            if n_len <= m_len:
+                break
+            ip += 1
+            m_len, m_off = n_len, n_off
+        if m_len == 0:
+            ip += 1
+            continue
+
+        if ip > ii:
+            write_literals(dst, src, ii, ip - ii)
+        write_match(dst, m_len, m_off)
+        ip += m_len
+        ii = ip
+
+    if length > ii:
+        write_literals(dst, src, ii, length - ii)
+
+    dst.append(16 | 1)
+    dst.append(0)
+    dst.append(0)
+
+    return str(dst)
+
+
+def find_match(s, head, chain, ip, max_chain, nice_length):
+    best_len = 0
+    best_off = 0
+    limit = len(s) - ip
+    i = head.get(s[ip: ip + 3], -1)
+    while i >= 0 and max_chain > 0:
+        m_off = ip - i
+        if m_off > 0xbfff:
+            break
+        if best_len == 0 or (best_len < limit and s[i + best_len] == s[ip + best_len]):
+            m_len = 3
+            while m_len + 16 <= limit and s[i + m_len: i + m_len + 16] == s[ip + m_len: ip + m_len + 16]:
+                m_len += 16
+            while m_len < limit and s[i + m_len] == s[ip + m_len]:
+                m_len += 1
+            # A match has to save a byte more than its own code, for the
+            # literal run header it can force after it
+            if m_len > best_len and m_len - match_code_size(m_len, m_off) >= 2:
+                best_len = m_len
+                best_off = m_off
+                if m_len >= nice_length:
+                    break
+        i = chain[i]
+        max_chain -= 1
+    return best_len, best_off
+
+
+def match_code_size(m_len, m_off):
+    # Bytes write_match takes for a short match; longer ones save plenty
+    if m_len <= 8 and m_off <= 0x0800:
+        return 2
+    return 3
+
+
+def write_literals(dst, src, ii, t):
+    if len(dst) == 5 and t <= 238:
+        dst.append(17 + t)
+    elif t <= 3:
+        dst[-2] |= t
+    elif t <= 18:
+        dst.append(t - 3)
+    else:
+        tt = t - 18
+        dst.append(0)
+        # The final count byte must be non-zero, so a multiple of 255 ends in 255
+        n, tt = divmod(tt - 1, 255)
+        dst.extend("\x00" * n)
+        dst.append(tt + 1)
+    dst.extend(src[ii: ii + t])
+
+
+def write_match(dst, m_len, m_off):
+    if m_len <= 8 and m_off <= 0x0800:
+        m_off -= 1
+        dst.append(((m_len - 1) << 5) | ((m_off & 7) << 2))
+        dst.append(m_off >> 3)
+        return
+    elif m_off <= 0x4000:
+        m_off -= 1
+        if m_len <= 33:
+            dst.append(32 | (m_len - 2))
+        else:
+            m_len -= 33
+            dst.append(32)
+            n, m_len = divmod(m_len - 1, 255)
+            dst.extend("\x00" * n)
+            dst.append(m_len + 1)
+    else:
+        m_off -= 0x4000
+        if m_len <= 9:
+            dst.append(0xff & (16 | ((m_off >> 11) & 8) | (m_len - 2)))
+        else:
+            m_len -= 9
+            dst.append(0xff & (16 | ((m_off >> 11) & 8)))
+            n, m_len = divmod(m_len - 1, 255)
+            dst.extend("\x00" * n)
+            dst.append(m_len + 1)
+    dst.append((m_off << 2) & 0xff)
+    dst.append((m_off >> 6) & 0xff)
+
+
 def compress_core(src, dst, ti, ip_start, ip_len):
     dict_entries = [0] * 16384
 
@@ -87,9 +382,9 @@ def compress_core(src, dst, ti, ip_start, ip_len):
                 else:
                     tt = t - 18
                     dst.append(0)
-                    n, tt = divmod(tt, 255)
+                    n, tt = divmod(tt - 1, 255)
                     dst.extend("\x00" * n)
-                    dst.append(tt)
+                    dst.append(tt + 1)
                 dst.extend(src[ii: ii + t])
                 ii += t
 
@@ -121,9 +416,9 @@ def compress_core(src, dst, ti, ip_start, ip_len):
             else:
                 m_len -= 33
                 dst.append(32)
-                n, m_len = divmod(m_len, 255)
+                n, m_len = divmod(m_len - 1, 255)
                 dst.extend("\x00" * n)
-                dst.append(m_len)
+                dst.append(m_len + 1)
             dst.append((m_off << 2) & 0xff)
             dst.append((m_off >> 6) & 0xff)
         else:
@@ -133,30 +428,47 @@ def compress_core(src, dst, ti, ip_start, ip_len):
             else:
                 m_len -= 9
                 dst.append(0xff & (16 | ((m_off >> 11) & 8)))
-                n, m_len = divmod(m_len, 255)
+                n, m_len = divmod(m_len - 1, 255)
                 dst.extend("\x00" * n)
-                dst.append(m_len)
+                dst.append(m_len + 1)
             dst.append((m_off << 2) & 0xff)
             dst.append((m_off >> 6) & 0xff)
 
 
-def decompress(s):
-    dst = bytearray()
-    src = bytearray(s)
-    ip = 5
+def python_decompress(s):
+    dst = bytearray(decompressed_size(s))
+    check_decompressed_size(len(dst), python_decompress_into(s, dst))
+    return str(dst)
+
+
+def python_decompress_into(s, dst, start=1):
+    # Indexing needs a bytearray, anything else has to be copied into one.
+    # A stream that ends early runs off the end of src, and fails as it does
+    # with the native backends.
+    src = s if type(s) is bytearray else bytearray(s)
+    try:
+        return decompress_core(src, dst, start + 4)
+    except IndexError:
+        raise ERRNO("LZO decompression failed")
+
+
+def decompress_core(src, dst, ip):
+    op = 0
 
     t = src[ip]
     ip += 1
     if t > 17:
         t = t - 17
-        dst.extend(src[ip: ip + t])
+        dst[op: op + t] = src[ip: ip + t]
+        op += t
         ip += t
         t = src[ip]
         ip += 1
     elif t < 16:
         if t == 0:
             t, ip = expand_zeroes(src, ip, 15)
-        dst.extend(src[ip: ip + t + 3])
+        dst[op: op + t + 3] = src[ip: ip + t + 3]
+        op += t + 3
         ip += t + 3
         t = src[ip]
         ip += 1
@@ -164,14 +476,14 @@ def decompress(s):
     while 1:
         while 1:
             if t >= 64:
-                copy_earlier(dst, 1 + ((t >> 2) & 7) + (src[ip] << 3), (t >> 5) + 1)
+                op = copy_earlier_into(dst, op, 1 + ((t >> 2) & 7) + (src[ip] << 3), (t >> 5) + 1)
                 ip += 1
             elif t >= 32:
                 count = t & 31
                 if count == 0:
                     count, ip = expand_zeroes(src, ip, 31)
                 t = src[ip]
-                copy_earlier(dst, 1 + ((t | (src[ip + 1] << 8)) >> 2), count + 2)
+                op = copy_earlier_into(dst, op, 1 + ((t | (src[ip + 1] << 8)) >> 2), count + 2)
                 ip += 2
             elif t >= 16:
                 offset = (t & 8) << 11
@@ -182,16 +494,17 @@ def decompress(s):
                 offset += (t | (src[ip + 1] << 8)) >> 2
                 ip += 2
                 if offset == 0:
-                    return str(dst)
-                copy_earlier(dst, offset + 0x4000, count + 2)
+                    return op
+                op = copy_earlier_into(dst, op, offset + 0x4000, count + 2)
             else:
-                copy_earlier(dst, 1 + (t >> 2) + (src[ip] << 2), 2)
+                op = copy_earlier_into(dst, op, 1 + (t >> 2) + (src[ip] << 2), 2)
                 ip += 1
 
             t = t & 3
             if t == 0:
                 break
-            dst.extend(src[ip: ip + t])
+            dst[op: op + t] = src[ip: ip + t]
+            op += t
             ip += t
             t = src[ip]
             ip += 1
@@ -202,17 +515,19 @@ def decompress(s):
             if t < 16:
                 if t == 0:
                     t, ip = expand_zeroes(src, ip, 15)
-                dst.extend(src[ip: ip + t + 3])
+                dst[op: op + t + 3] = src[ip: ip + t + 3]
+                op += t + 3
                 ip += t + 3
                 t = src[ip]
                 ip += 1
             if t < 16:
-                copy_earlier(dst, 1 + 0x0800 + (t >> 2) + (src[ip] << 2), 3)
+                op = copy_earlier_into(dst, op, 1 + 0x0800 + (t >> 2) + (src[ip] << 2), 3)
                 ip += 1
                 t = t & 3
                 if t == 0:
                     continue
-                dst.extend(src[ip: ip + t])
+                dst[op: op + t] = src[ip: ip + t]
+                op += t
                 ip += t
                 t = src[ip]
                 ip += 1
@@ -223,3 +538,26 @@ def read_xor32(src, p1, p2):
     v1 = src[p1] | (src[p1 + 1] << 8) | (src[p1 + 2] << 16) | (src[p1 + 3] << 24)
     v2 = src[p2] | (src[p2 + 1] << 8) | (src[p2 + 2] << 16) | (src[p2 + 3] << 24)
     return v1 ^ v2
+
+
+def expand_zeroes(src, ip, extra):
+    start = ip
+    while src[ip] == 0:
+        ip = ip + 1
+    v = ((ip - start) * 255) + src[ip]
+    return v + extra, ip + 1
+
+
+def copy_earlier_into(b, op, offset, n):
+    i = op - offset
+    if i < 0:
+        raise ERRNO("LZO decompression failed: match before the start of the output")
+    if n <= offset:
+        b[op: op + n] = b[i: i + n]
+    else:
+        # An overlapping copy repeats the last offset bytes
+        b[op: op + n] = (b[i: op] * (n // offset + 1))[: n]
+    return op + n
+
+
+use_backend()
@@ -2,42 +2,26 @@ import binascii
 import math
 import struct
 import random
-from cStringIO import StringIO
+from json.encoder import encode_basestring_ascii
 
+import instrument
 from error import ERRNO
-from presents import unwrap_player_data, unwrap_item, wrap_item, wrap_player_data
-from read import read_repeated_protobuf_value, read_protobuf, read_protobuf_value
-from write import write_protobuf_value, write_protobuf, write_repeated_protobuf_value
+from presents import unwrap_player_data, unwrap_player_tree, wrap_player_data, unwrap_items, wrap_items, rekey_items, store_items
+from presents import wrap_raw_items, xor_data, rotate_data_right
+from read import read_repeated_protobuf_value, read_protobuf, decode_packed, MessageView
+from write import write_protobuf, write_repeated_protobuf_value, encode_packed
 
-
-def rotate_data_right(data, steps):
-    steps = steps % len(data)
-    return data[-steps:] + data[: -steps]
-
-
-def rotate_data_left(data, steps):
-    steps = steps % len(data)
-    return data[steps:] + data[: steps]
-
-
-def xor_data(data, key):
-    key = key & 0xffffffff
-    output = ""
-    for c in data:
-        key = (key * 279470273) % 4294967291
-        output += chr((ord(c) ^ key) & 0xff)
-    return output
+# Compiled structures and inverses by id, each kept with its structure so the
+# id cannot be reused
+compiled_structures = {}
+compiled_inverses = {}
+inverted_structures = {}
 
 
 def replace_raw_item_key(data, key):
     old_key = struct.unpack(">i", data[1: 5])[0]
     item = rotate_data_right(xor_data(data[5:], old_key >> 5), old_key & 31)[2:]
-    header = data[0] + struct.pack(">i", key)
-    padding = "\xff" * (33 - len(item))
-    h = binascii.crc32(header + "\xff\xff" + item + padding) & 0xffffffff
-    checksum = struct.pack(">H", ((h >> 16) ^ h) & 0xffff)
-    body = xor_data(rotate_data_left(checksum + item, key & 31), key >> 5)
-    return header + body
+    return wrap_raw_items([data[0]], [item], [key])[0]
 
 
 def parse_zigzag(i):
@@ -48,87 +32,278 @@ def parse_zigzag(i):
 
 
 def apply_structure(pbdata, s):
+    return compile_structure(s)[1](pbdata)
+
+
+def compile_structure(s):
+    # Compiles a structure, once, into a decoder that gives apply_structure's
+    # tree for a read_protobuf dict and a function that gives the sorted,
+    # lazily decoded items dump_json writes for a MessageView. Mistakes in
+    # the structure are raised here, not when a save first uses them.
+    compiled = compiled_structures.get(id(s))
+    if compiled is not None and compiled[0] is s:
+        return compiled
     fields = {}
-    raw = {}
-    for k, data in pbdata.items():
-        mapping = s.get(k)
-        if mapping is None:
-            raw[k] = data
-            continue
-        elif type(mapping) is str:
-            fields[mapping] = data[0][1]
-            continue
-        key, repeated, child_s = mapping
-        if child_s is None:
-            values = [d[1] for d in data]
-            fields[key] = values if repeated else values[0]
-        elif type(child_s) is int:
-            if repeated:
-                fields[key] = read_repeated_protobuf_value(data[0][1], child_s)
+    names = set(["_raw"])
+    for k, mapping in s.items():
+        name, repeated, child_s = structure_mapping(k, mapping)
+        if name in names:
+            raise ERRNO("Duplicate name %r in structure" % (name,))
+        names.add(name)
+        fields[k] = (name, repeated, child_s, field_decoder(repeated, child_s))
+
+    def decode(pbdata):
+        values = {}
+        raw = {}
+        for k, data in pbdata.items():
+            field = fields.get(k)
+            if field is None:
+                raw[k] = data
+                continue
+            values[field[0]] = field[3](data)
+        if len(raw) != 0:
+            values["_raw"] = dict([(k, raw_values(data)) for (k, data) in raw.items()])
+        return values
+
+    def items(message):
+        values = {}
+        raw = []
+        for k in message.spans:
+            field = fields.get(k)
+            if field is None:
+                raw.append(k)
+                continue
+            name, repeated, child_s, decode_field = field
+            if type(child_s) is dict:
+                child_items = compile_structure(child_s)[2]
+                views = [structure_message(message.data, a, b, child_items) for (_, _, a, b) in message.spans[k]]
+                values[name] = views if repeated else views[0]
             else:
-                fields[key] = data[0][1]
-        elif type(child_s) is tuple:
-            values = [child_s[0](d[1]) for d in data]
-            fields[key] = values if repeated else values[0]
-        elif type(child_s) is dict:
-            values = [apply_structure(read_protobuf(d[1]), child_s) for d in data]
-            fields[key] = values if repeated else values[0]
+                values[name] = decoded_field(message, k, decode_field)
+        if len(raw) != 0:
+            values["_raw"] = lambda level: json_dict_chunks([(k, raw_field(message, k)) for k in sorted(raw)], level)
+        return sorted(values.items())
+
+    compiled = compiled_structures[id(s)] = (s, decode, items)
+    return compiled
+
+
+def structure_mapping(k, mapping):
+    if type(mapping) is str:
+        return mapping, False, None
+    if type(mapping) is tuple and len(mapping) == 3 and type(mapping[0]) is str:
+        child_s = mapping[2]
+        if child_s is None or type(child_s) is dict:
+            return mapping
+        elif type(child_s) is int and child_s in (0, 1, 2, 5):
+            return mapping
+        elif type(child_s) is tuple and len(child_s) == 2 and all(map(callable, child_s)):
+            return mapping
+    raise ERRNO("Invalid mapping %r for %r" % (mapping, k))
+
+
+def field_decoder(repeated, child_s):
+    if child_s is None:
+        if repeated:
+            return lambda data: [d[1] for d in data]
+        return lambda data: data[0][1]
+    elif type(child_s) is int:
+        if repeated:
+            return lambda data: decode_packed(data[0][1], child_s)
+        return lambda data: data[0][1]
+    elif type(child_s) is tuple:
+        unwrap = child_s[0]
+        if repeated:
+            return lambda data: [unwrap(d[1]) for d in data]
+        return lambda data: unwrap(data[0][1])
+    decode = compile_structure(child_s)[1]
+    if repeated:
+        return lambda data: [decode(read_protobuf(d[1])) for d in data]
+    return lambda data: decode(read_protobuf(data[0][1]))
+
+
+def raw_values(data):
+    safe_values = []
+    for (wire_type, v) in data:
+        if wire_type == 2:
+            v = [ord(c) for c in v]
+        safe_values.append([wire_type, v])
+    return safe_values
+
+
+def dump_json(player, output, structure=None):
+    # Writes a freshly read MessageView to output as the JSON that json.dumps
+    # with sort_keys and an indent of 4 gives for its read_protobuf dict, or
+    # for its apply_structure tree when a structure is given. Fields are
+    # decoded as they are written, so neither tree is ever built.
+    if structure is None:
+        items = [(k, decoded_field(player, k)) for k in sorted(player.spans)]
+    else:
+        items = compile_structure(structure)[2](player)
+    output.writelines(json_dict_chunks(items, 0))
+
+
+def structure_message(data, start, end, items):
+    return lambda level: json_dict_chunks(items(MessageView(data, start, end)), level)
+
+
+def decoded_field(message, k, decode=None):
+    if decode is None:
+        return lambda level: json_chunks(message.read(k), level)
+    return lambda level: json_chunks(decode(message.read(k)), level)
+
+
+def raw_field(message, k):
+    return lambda level: json_chunks(raw_values(message.read(k)), level)
+
+
+def json_scalar(value):
+    # The JSON for a value that is not a container, otherwise None
+    if isinstance(value, basestring):
+        if type(value) is str:
+            value = value.decode("latin1")
+        return encode_basestring_ascii(value)
+    elif value is None:
+        return "null"
+    elif value is True:
+        return "true"
+    elif value is False:
+        return "false"
+    elif isinstance(value, (int, long)):
+        return str(value)
+    elif isinstance(value, float):
+        if value != value:
+            return "NaN"
+        elif value == float("inf"):
+            return "Infinity"
+        elif value == -float("inf"):
+            return "-Infinity"
+        return repr(value)
+    return None
+
+
+def json_chunks(value, level):
+    # Chunks of JSON for a value, in the layout json.dumps gives with
+    # sort_keys and an indent of 4. Callables stand for values that are only
+    # decoded when written and return the chunks for themselves.
+    text = json_scalar(value)
+    if text is not None:
+        return [text]
+    elif callable(value):
+        return value(level)
+    elif isinstance(value, (list, tuple)):
+        return json_list_chunks(value, level)
+    elif isinstance(value, dict):
+        return json_dict_chunks(sorted(value.items(), key=lambda kv: kv[0]), level)
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+
+def json_list_chunks(values, level):
+    if len(values) == 0:
+        yield "[]"
+        return
+    indent = "\n" + " " * (4 * (level + 1))
+    yield "[" + indent
+    separator = ", " + indent
+    for i, value in enumerate(values):
+        if i != 0:
+            yield separator
+        text = json_scalar(value)
+        if text is not None:
+            yield text
         else:
-            raise Exception("Invalid mapping %r for %r: %r" % (mapping, k, data))
-    if len(raw) != 0:
-        fields["_raw"] = {}
-        for k, values in raw.items():
-            safe_values = []
-            for (wire_type, v) in values:
-                if wire_type == 2:
-                    v = [ord(c) for c in v]
-                safe_values.append([wire_type, v])
-            fields["_raw"][k] = safe_values
-    return fields
+            for chunk in json_chunks(value, level + 1):
+                yield chunk
+    yield "\n" + " " * (4 * level) + "]"
+
+
+def json_dict_chunks(items, level):
+    if len(items) == 0:
+        yield "{}"
+        return
+    indent = "\n" + " " * (4 * (level + 1))
+    yield "{" + indent
+    separator = ", " + indent
+    for i, (key, value) in enumerate(items):
+        if i != 0:
+            yield separator
+        name = key if isinstance(key, basestring) else json_scalar(key)
+        if name is None:
+            raise TypeError("key " + repr(key) + " is not a string")
+        yield json_scalar(name) + ": "
+        text = json_scalar(value)
+        if text is not None:
+            yield text
+        else:
+            for chunk in json_chunks(value, level + 1):
+                yield chunk
+    yield "\n" + " " * (4 * level) + "}"
 
 
 def remove_structure(data, inv):
-    pbdata = {}
-    pbdata.update(data.get("_raw", {}))
-    for k, value in data.items():
-        if k == "_raw":
-            continue
-        mapping = inv.get(k)
-        if mapping is None:
-            raise ERRNO("Unknown key %r in data" % (k,))
-        elif type(mapping) is int:
-            pbdata[mapping] = [[guess_wire_type(value), value]]
-            continue
-        key, repeated, child_inv = mapping
-        if child_inv is None:
+    return compile_inverse(inv)(data)
+
+
+def compile_inverse(inv):
+    # Compiles an inverted structure, once, into an encoder that gives the
+    # read_protobuf dict for an apply_structure tree
+    compiled = compiled_inverses.get(id(inv))
+    if compiled is not None and compiled[0] is inv:
+        return compiled[1]
+    encoders = dict([(k, field_encoder(k, mapping)) for (k, mapping) in inv.items()])
+
+    def encode(data):
+        pbdata = {}
+        pbdata.update(data.get("_raw", {}))
+        for k, value in data.items():
+            if k == "_raw":
+                continue
+            encoder = encoders.get(k)
+            if encoder is None:
+                raise ERRNO("Unknown key %r in data" % (k,))
+            key, entries = encoder(value)
+            pbdata[key] = entries
+        return pbdata
+
+    compiled_inverses[id(inv)] = (inv, encode)
+    return encode
+
+
+def field_encoder(k, mapping):
+    if type(mapping) is int:
+        return lambda value: (mapping, [[guess_wire_type(value), value]])
+    if type(mapping) is not tuple or len(mapping) != 3:
+        raise ERRNO("Invalid mapping %r for %r" % (mapping, k))
+    key, repeated, child_inv = mapping
+    if child_inv is None:
+        def encode(value):
             value = [value] if not repeated else value
-            pbdata[key] = [[guess_wire_type(v), v] for v in value]
-        elif type(child_inv) is int:
-            if repeated:
-                b = StringIO()
-                for v in value:
-                    write_protobuf_value(b, child_inv, v)
-                pbdata[key] = [[2, b.getvalue()]]
-            else:
-                pbdata[key] = [[child_inv, value]]
-        elif type(child_inv) is tuple:
+            return key, [[guess_wire_type(v), v] for v in value]
+    elif type(child_inv) is int:
+        if repeated:
+            return lambda value: (key, [[2, encode_packed(value, child_inv)]])
+        return lambda value: (key, [[child_inv, value]])
+    elif type(child_inv) is tuple:
+        wrap = child_inv[1]
+
+        def encode(value):
             value = [value] if not repeated else value
             values = []
-            for v in map(child_inv[1], value):
+            for v in map(wrap, value):
                 if type(v) is list:
                     values.append(v)
                 else:
                     values.append([guess_wire_type(v), v])
-            pbdata[key] = values
-        elif type(child_inv) is dict:
+            return key, values
+    elif type(child_inv) is dict:
+        encode_child = compile_inverse(child_inv)
+
+        def encode(value):
             value = [value] if not repeated else value
-            values = []
-            for d in [remove_structure(v, child_inv) for v in value]:
-                values.append([2, write_protobuf(d)])
-            pbdata[key] = values
-        else:
-            raise Exception("Invalid mapping %r for %r: %r" % (mapping, k, value))
-    return pbdata
+            return key, [[2, write_protobuf(encode_child(v))] for v in value]
+    else:
+        raise ERRNO("Invalid mapping %r for %r" % (mapping, k))
+    return encode
 
 
 def guess_wire_type(value):
@@ -136,6 +311,11 @@ def guess_wire_type(value):
 
 
 def invert_structure(structure):
+    # The inverse is built once per structure, so that its compiled encoder
+    # is reused as well
+    inverted = inverted_structures.get(id(structure))
+    if inverted is not None and inverted[0] is structure:
+        return inverted[1]
     inv = {}
     for k, v in structure.items():
         if type(v) is tuple:
@@ -145,34 +325,29 @@ def invert_structure(structure):
                 inv[v[0]] = (k,) + v[1:]
         else:
             inv[v] = k
+    inverted_structures[id(structure)] = (structure, inv)
     return inv
 
 
-def expand_zeroes(src, ip, extra):
-    start = ip
-    while src[ip] == 0:
-        ip = ip + 1
-    v = ((ip - start) * 255) + src[ip]
-    return v + extra, ip + 1
-
-
-def copy_earlier(b, offset, n):
-    i = len(b) - offset
-    end = i + n
-    while i < end:
-        chunk = b[i: i + n]
-        i = i + len(chunk)
-        n = n - len(chunk)
-        b.extend(chunk)
+def parse_changes(modifications):
+    # Turns "money=99999999,eridium=99" into the changes for modify_save
+    changes = {}
+    if modifications:
+        for m in modifications.split(","):
+            k, v = (m.split("=", 1) + [None])[: 2]
+            changes[k] = v
+    return changes
 
 
-def modify_save(data, changes):
-    player = read_protobuf(unwrap_player_data(data))
+def modify_save(data, changes, level=1):
+    player, tree = unwrap_player_tree(data)
+    player = MessageView(player)
+    started = instrument.start()
 
     if changes.has_key("level"):
-        level = int(changes["level"])
-        lower = int(60 * (level ** 2.8) - 59.2)
-        upper = int(60 * ((level + 1) ** 2.8) - 59.2)
+        player_level = int(changes["level"])
+        lower = int(60 * (player_level ** 2.8) - 59.2)
+        upper = int(60 * ((player_level + 1) ** 2.8) - 59.2)
         if player[3][0][1] not in range(lower, upper):
             player[3][0][1] = lower
         player[2] = [[0, int(changes["level"])]]
@@ -181,11 +356,7 @@ def modify_save(data, changes):
         player[4] = [[0, int(changes["skillpoints"])]]
 
     if any(map(changes.has_key, ("money", "eridium", "seraph", "tokens"))):
-        raw = player[6][0][1]
-        b = StringIO(raw)
-        values = []
-        while b.tell() < len(raw):
-            values.append(read_protobuf_value(b, 0))
+        values = decode_packed(player[6][0][1], 0)
         if changes.has_key("money"):
             values[0] = int(changes["money"])
         if changes.has_key("eridium"):
@@ -198,25 +369,21 @@ def modify_save(data, changes):
 
     if changes.has_key("itemlevels"):
         if changes["itemlevels"]:
-            level = int(changes["itemlevels"])
+            item_level = int(changes["itemlevels"])
         else:
-            level = player[2][0][1]
-        for field_number in (53, 54):
-            for field in player[field_number]:
-                field_data = read_protobuf(field[1])
-                is_weapon, item, key = unwrap_item(field_data[1][0][1])
-                if item[4] > 1:
-                    item = item[: 4] + [level, level] + item[6:]
-                    field_data[1][0][1] = wrap_item(is_weapon, item, key)
-                    field[1] = write_protobuf(field_data)
+            item_level = player[2][0][1]
+        items = unwrap_items(player, (53, 54))
+        rows = [row for (row, levels) in enumerate(items["level"]) if levels[0] > 1]
+        for row in rows:
+            items["level"][row] = [item_level, item_level]
+        store_items(items, rows, wrap_items(items, rows))
 
     if changes.has_key("backpack"):
         size = int(changes["backpack"])
         sdus = int(math.ceil((size - 12) / 3.0))
         size = 12 + (sdus * 3)
-        slots = read_protobuf(player[13][0][1])
+        slots = player.message(13)
         slots[1][0][1] = size
-        player[13][0][1] = write_protobuf(slots)
         s = read_repeated_protobuf_value(player[36][0][1], 0)
         player[36][0][1] = write_repeated_protobuf_value(s[: 7] + [sdus] + s[8:], 0)
 
@@ -235,11 +402,10 @@ def modify_save(data, changes):
 
     if changes.get("gunslots", "0") in "234":
         n = int(changes["gunslots"])
-        slots = read_protobuf(player[13][0][1])
+        slots = player.message(13)
         slots[2][0][1] = n
         if slots[3][0][1] > n - 2:
             slots[3][0][1] = n - 2
-        player[13][0][1] = write_protobuf(slots)
 
     if changes.has_key("unlocks"):
         unlocked, notifications = [], []
@@ -261,25 +427,34 @@ def modify_save(data, changes):
             if player[7][0][1] < 1:
                 player[7][0][1] = 1
 
-    return wrap_player_data(write_protobuf(player))
+    size = len(player.data)
+    player = write_protobuf(player)
+    instrument.finish(started, "modify", size, len(player))
+    return wrap_player_data(player, level=level, tree=tree)
 
 
 def export_items(data, output):
-    player = read_protobuf(unwrap_player_data(data))
+    player = MessageView(unwrap_player_data(data))
+    started = instrument.start()
+    items = unwrap_items(player, unpack=False)
+    raws = rekey_items(items, 0)
     for i, name in ((41, "Bank"), (53, "Items"), (54, "Weapons")):
         content = player.get(i)
         if content is None:
             continue
         print >> output, "; " + name
-        for field in content:
-            raw = read_protobuf(field[1])[1][0][1]
-            raw = replace_raw_item_key(raw, 0)
+        for field, raw in zip(items["field"], raws):
+            if field != i:
+                continue
             code = "BL2(" + raw.encode("base64").strip() + ")"
             print >> output, code
+    instrument.finish(started, "export", len(player.data), None)
 
 
-def import_items(data, codelist):
-    player = read_protobuf(unwrap_player_data(data))
+def import_items(data, codelist, level=1):
+    player, tree = unwrap_player_tree(data)
+    player = MessageView(player)
+    started = instrument.start()
 
     to_bank = False
     for line in codelist.splitlines():
@@ -314,4 +489,7 @@ def import_items(data, codelist):
 
         player.setdefault(field, []).append([2, write_protobuf(entry)])
 
-    return wrap_player_data(write_protobuf(player))
+    size = len(player.data)
+    player = write_protobuf(player)
+    instrument.finish(started, "import", size, len(player))
+    return wrap_player_data(player, level=level, tree=tree)
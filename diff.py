@@ -0,0 +1,250 @@
+import json
+import optparse
+import os
+import sys
+
+from data import compile_structure, structure_mapping, field_decoder, raw_values
+from pool import map_jobs
+from presents import unwrap_player_data, save_structure, item_fields
+from read import read_protobuf
+
+
+def diff_saves(a, b):
+    # The changes from save game a to save game b. Saves starting with the
+    # same SHA1 are the same save, and are never decoded.
+    if a[: 20] == b[: 20]:
+        return []
+    return diff_players(unwrap_player_data(a), unwrap_player_data(b))
+
+
+def diff_players(a, b, structure=save_structure):
+    # The changes from player protobuf a to b as (kind, path, old, new), kind
+    # being "added", "removed" or "changed" and path naming the field as
+    # apply_structure does, like missions[0].data[3].status. Items in the
+    # bank, backpack and weapon slots are matched by what they are rather
+    # than where they are, so moving or adding one doesn't change the rest.
+    changes = []
+    if a != b:
+        diff_message(read_protobuf(a), read_protobuf(b), structure, "", changes, item_fields)
+    return changes
+
+
+def diff_message(a, b, structure, path, changes, items=()):
+    # Fields are only decoded where their raw entries differ, and messages
+    # are only descended into where their bytes do
+    for k in sorted(set(a) | set(b)):
+        entries_a = a.get(k, [])
+        entries_b = b.get(k, [])
+        if entries_a == entries_b:
+            continue
+        mapping = structure.get(k)
+        if mapping is None:
+            path_k = join_path(path, "_raw.%d" % k)
+            diff_values(raw_values(entries_a) or None, raw_values(entries_b) or None, path_k, changes)
+            continue
+        name, repeated, child_s = structure_mapping(k, mapping)
+        path_k = join_path(path, name)
+        if k in items:
+            diff_items(entries_a, entries_b, child_s, path_k, changes)
+        elif type(child_s) is dict:
+            decode = compile_structure(child_s)[1]
+            for i in xrange(max(len(entries_a), len(entries_b))):
+                path_i = "%s[%d]" % (path_k, i) if repeated else path_k
+                if i >= len(entries_b):
+                    changes.append(("removed", path_i, decode(read_protobuf(entries_a[i][1])), None))
+                elif i >= len(entries_a):
+                    changes.append(("added", path_i, None, decode(read_protobuf(entries_b[i][1]))))
+                elif entries_a[i][1] != entries_b[i][1]:
+                    message_a = read_protobuf(entries_a[i][1])
+                    message_b = read_protobuf(entries_b[i][1])
+                    diff_message(message_a, message_b, child_s, path_i, changes)
+        else:
+            decode = field_decoder(repeated, child_s)
+            old = decode(entries_a) if entries_a else None
+            new = decode(entries_b) if entries_b else None
+            diff_values(old, new, path_k, changes)
+
+
+def diff_values(old, new, path, changes):
+    if old == new:
+        return
+    if old is None:
+        changes.append(("added", path, None, new))
+    elif new is None:
+        changes.append(("removed", path, old, None))
+    elif type(old) is dict and type(new) is dict:
+        for k in sorted(set(old) | set(new)):
+            diff_values(old.get(k), new.get(k), join_path(path, k), changes)
+    elif type(old) is list and type(new) is list and len(old) == len(new):
+        for i, (v, w) in enumerate(zip(old, new)):
+            diff_values(v, w, "%s[%d]" % (path, i), changes)
+    else:
+        changes.append(("changed", path, old, new))
+
+
+def diff_items(entries_a, entries_b, child_s, path, changes):
+    # Items with the same bytes in both are dropped first. The rest are
+    # decoded and paired up by item_identity, so a changed level or slot is
+    # reported as a change of that item, and anything left over as an item
+    # added or removed. Item keys only scramble the item, so they are
+    # ignored.
+    unchanged = {}
+    for j, entry in enumerate(entries_b):
+        unchanged.setdefault(entry[1], []).append(j)
+    old = []
+    for i, entry in enumerate(entries_a):
+        if unchanged.get(entry[1]):
+            unchanged[entry[1]].pop(0)
+        else:
+            old.append(i)
+    new = sorted(j for indices in unchanged.values() for j in indices)
+    if not old and not new:
+        return
+
+    decode = compile_structure(child_s)[1]
+    remaining = {}
+    decoded = {}
+    for j in new:
+        item = decode(read_protobuf(entries_b[j][1]))
+        decoded[j] = item
+        remaining.setdefault(item_identity(item), []).append(j)
+    for i in old:
+        item = decode(read_protobuf(entries_a[i][1]))
+        matches = remaining.get(item_identity(item))
+        if not matches:
+            changes.append(("removed", "%s[%d]" % (path, i), item, None))
+            continue
+        j = matches.pop(0)
+        item, match = without_key(item), without_key(decoded[j])
+        # Both levels of an item change together, so they make one change
+        if item["data"]["level"] != match["data"]["level"]:
+            changes.append(("changed", "%s[%d].data.level" % (path, j), item["data"]["level"], match["data"]["level"]))
+            match["data"]["level"] = item["data"]["level"]
+        diff_values(item, match, "%s[%d]" % (path, j), changes)
+    for j in sorted(j for indices in remaining.values() for j in indices):
+        changes.append(("added", "%s[%d]" % (path, j), None, decoded[j]))
+
+
+def item_identity(item):
+    # What an item is, leaving out what changes to it, its level and key,
+    # and where it is kept
+    data = item["data"]
+    parts = tuple(None if part is None else (part["lib"], part["asset"]) for part in data["parts"])
+    ids = tuple((data[k]["lib"], data[k]["asset"]) for k in ("type", "balance", "manufacturer"))
+    return (data["is_weapon"], data["set"]) + ids + parts
+
+
+def without_key(item):
+    data = dict(item["data"])
+    del data["key"]
+    return dict(item, data=data)
+
+
+def describe_item(data):
+    # Items cut short before their level have none
+    level = data["level"][0]
+    return "%s level %s, set %d, type %d:%d, balance %d:%d, manufacturer %d:%d" % (
+        "weapon" if data["is_weapon"] else "item", "?" if level is None else level, data["set"],
+        data["type"]["lib"], data["type"]["asset"], data["balance"]["lib"], data["balance"]["asset"],
+        data["manufacturer"]["lib"], data["manufacturer"]["asset"]
+    )
+
+
+def value_text(value):
+    if type(value) is dict and type(value.get("data")) is dict and "is_weapon" in value["data"]:
+        return describe_item(value["data"])
+    return json.dumps(value, sort_keys=True, encoding="latin1")
+
+
+def change_text(change):
+    kind, path, old, new = change
+    if kind == "added":
+        return "+ %s: %s" % (path, value_text(new))
+    elif kind == "removed":
+        return "- %s: %s" % (path, value_text(old))
+    return "~ %s: %s -> %s" % (path, value_text(old), value_text(new))
+
+
+def join_path(path, name):
+    return "%s.%s" % (path, name) if path else str(name)
+
+
+def save_pairs(a, b):
+    # Pairs of paths to compare, with None for a save only one side has. Two
+    # directories are paired up by the names of their .sav files.
+    if not (os.path.isdir(a) and os.path.isdir(b)):
+        return [(a, b)]
+    names = set()
+    for directory in (a, b):
+        names.update(name for name in os.listdir(directory) if name.lower().endswith(".sav"))
+    pairs = []
+    for name in sorted(names):
+        path_a, path_b = os.path.join(a, name), os.path.join(b, name)
+        pairs.append((path_a if os.path.isfile(path_a) else None, path_b if os.path.isfile(path_b) else None))
+    return pairs
+
+
+def diff_pair(pair):
+    # Returns whether the pair could be read, and its changes or error
+    path_a, path_b = pair
+    try:
+        if path_a is None or path_b is None:
+            return True, None
+        return True, diff_saves(open(path_a, "rb").read(), open(path_b, "rb").read())
+    except Exception as e:
+        return False, "%s: %s" % (type(e).__name__, e)
+
+
+def diff_pairs(pairs, processes=1):
+    # Yields every pair with its diff_pair result, in order
+    return map_jobs(diff_pair, pairs, processes)
+
+
+def main():
+    p = optparse.OptionParser(usage="%prog [options] old new\n\nold and new are save games or directories of them")
+    p.add_option(
+        "-q", "--brief", action="store_true",
+        help="only report which saves differ"
+    )
+    p.add_option(
+        "-j", "--json", action="store_true",
+        help="print each change as a line of JSON"
+    )
+    p.add_option(
+        "--jobs", metavar="N", type="int", default=1,
+        help="number of processes comparing directories, 0 for one per CPU"
+    )
+    options, args = p.parse_args()
+    if len(args) != 2:
+        p.error("Expected two save games or directories")
+
+    status = 0
+    pairs = save_pairs(args[0], args[1])
+    for (path_a, path_b), (ok, changes) in diff_pairs(pairs, options.jobs):
+        if not ok:
+            print >> sys.stderr, "error\t%s\t%s\t%s" % (path_a, path_b, changes)
+            status = 2
+            continue
+        if changes is None:
+            status = max(status, 1)
+            print "Only in %s: %s" % os.path.split(path_a or path_b)
+            continue
+        if not changes:
+            continue
+        status = max(status, 1)
+        if options.brief:
+            print "Saves %s and %s differ" % (path_a, path_b)
+        elif options.json:
+            for kind, path, old, new in changes:
+                change = {"old": path_a, "new": path_b, "kind": kind, "path": path, "from": old, "to": new}
+                print json.dumps(change, sort_keys=True, encoding="latin1")
+        else:
+            if len(pairs) > 1:
+                print "--- %s\n+++ %s" % (path_a, path_b)
+            for change in changes:
+                print change_text(change)
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
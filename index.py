@@ -0,0 +1,381 @@
+import binascii
+import glob
+import itertools
+import optparse
+import os
+import sqlite3
+import sys
+
+from pool import map_jobs
+from presents import unwrap_player_data, unwrap_items
+from read import MessageView
+from table import item_header_sizes
+
+# The item fields indexed, by their save_structure names
+item_field_names = {41: "bank", 53: "items", 54: "weapons"}
+
+schema = """
+create table if not exists saves (
+    path text primary key, sha1 text not null, size integer not null, mtime real not null
+);
+create index if not exists saves_sha1 on saves (sha1);
+create table if not exists players (
+    sha1 text primary key, items integer not null
+);
+create table if not exists items (
+    sha1 text not null, field integer not null, position integer not null, is_weapon integer not null,
+    item_set integer not null, type_lib integer not null, type_asset integer not null,
+    balance_lib integer not null, balance_asset integer not null,
+    manufacturer_lib integer not null, manufacturer_asset integer not null, level integer,
+    primary key (sha1, field, position)
+);
+create index if not exists items_balance on items (balance_lib, balance_asset);
+create index if not exists items_manufacturer on items (manufacturer_lib, manufacturer_asset);
+create index if not exists items_type on items (type_lib, type_asset);
+create index if not exists items_level on items (level);
+create table if not exists parts (
+    sha1 text not null, field integer not null, position integer not null, slot integer not null,
+    lib integer not null, asset integer not null,
+    primary key (sha1, field, position, slot)
+);
+create index if not exists parts_part on parts (lib, asset);
+"""
+
+
+def save_items(path):
+    # Decodes a save's items into rows for the items and parts tables. Runs
+    # in pool processes, so it takes a path and returns plain tuples.
+    data = open(path, "rb").read()
+    sha1 = binascii.hexlify(data[: 20])
+    batch = unwrap_items(MessageView(unwrap_player_data(data)), sorted(item_field_names))
+    items = []
+    parts = []
+    positions = dict.fromkeys(item_field_names, 0)
+    for row, field in enumerate(batch["field"]):
+        position = positions[field]
+        positions[field] = position + 1
+        is_weapon = batch["is_weapon"][row]
+        ids = ()
+        for name, bits in item_header_sizes[is_weapon]:
+            ids = ids + split_id(batch[name][row], bits)
+        items.append((sha1, field, position, is_weapon, batch["set"][row]) + ids + (batch["level"][row][0],))
+        for slot, part in enumerate(batch["parts"][row]):
+            if part is not None:
+                parts.append((sha1, field, position, slot) + split_id(part, 10 + is_weapon))
+    return sha1, items, parts
+
+
+def split_id(value, bits):
+    # The (lib, asset) of a packed item value, as unwrap_item_info splits them
+    if value is None:
+        return None, None
+    return value >> bits, value & ((1 << bits) - 1)
+
+
+def try_save_items(path):
+    try:
+        return True, save_items(path)
+    except Exception as e:
+        return False, "%s: %s" % (type(e).__name__, e)
+
+
+def save_paths(sources):
+    # Every .sav file in the given directories, and every file given or
+    # matching a glob
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            names = sorted(os.listdir(source))
+            paths.extend(os.path.join(source, name) for name in names if name.lower().endswith(".sav"))
+        elif os.path.isfile(source):
+            paths.append(source)
+        else:
+            paths.extend(sorted(glob.glob(source)))
+    return [os.path.abspath(path) for path in paths if os.path.isfile(path)]
+
+
+def parse_id(value):
+    # "lib" or "lib:asset", as the parsed JSON shows them
+    parts = value.split(":")
+    if len(parts) > 2:
+        raise ValueError("Expected LIB or LIB:ASSET, not " + repr(value))
+    return tuple(int(part) for part in parts)
+
+
+def parse_range(value):
+    # "72" or "70-72"
+    low, high = (value.split("-", 1) + [None])[: 2]
+    return int(low), int(high if high is not None else low)
+
+
+class ItemIndex(object):
+    # Every item in the bank, backpack and weapon slots of a set of saves,
+    # decoded as unwrap_item_info gives them. Items are stored once per
+    # distinct save, keyed by the SHA1 the save starts with, and saves are
+    # paths pointing at one. A file is only read again once its size or
+    # modification time changes, and only decoded again once its SHA1 does.
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, paths, processes=1, report=None):
+        # Indexes the saves at paths, calling report with whether each read
+        # worked, its path and what happened. Returns the number of saves
+        # decoded, skipped as unchanged and failed.
+        db = self.db
+        known = dict((row[0], row[1:]) for row in db.execute("select path, size, mtime from saves"))
+        indexed = set(row[0] for row in db.execute("select sha1 from players"))
+        decode = []
+        skipped = failed = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+                if known.get(path) == (st.st_size, st.st_mtime):
+                    skipped = skipped + 1
+                    continue
+                with open(path, "rb") as f:
+                    sha1 = binascii.hexlify(f.read(20))
+            except (IOError, OSError) as e:
+                self.remove_save(path)
+                failed = failed + 1
+                if report is not None:
+                    report(False, path, "%s: %s" % (type(e).__name__, e))
+                continue
+            if sha1 in indexed:
+                # Renamed, copied or touched, but the same save
+                self.add_save(path, sha1, st)
+                skipped = skipped + 1
+                if report is not None:
+                    report(True, path, "unchanged")
+                continue
+            decode.append((path, st))
+
+        decoded = 0
+        for (path, st), (ok, result) in itertools.izip(decode, self.decode([path for (path, _) in decode], processes)):
+            if not ok:
+                # Whatever the path held before is gone
+                self.remove_save(path)
+                failed = failed + 1
+                if report is not None:
+                    report(False, path, result)
+                continue
+            sha1, items, parts = result
+            if sha1 not in indexed:
+                try:
+                    self.add_items(sha1, items, parts)
+                except sqlite3.Error as e:
+                    self.remove_items(sha1)
+                    self.remove_save(path)
+                    failed = failed + 1
+                    if report is not None:
+                        report(False, path, "%s: %s" % (type(e).__name__, e))
+                    continue
+                indexed.add(sha1)
+            self.add_save(path, sha1, st)
+            decoded = decoded + 1
+            if report is not None:
+                report(True, path, "%d items" % len(items))
+        self.remove_orphans()
+        db.commit()
+        return decoded, skipped, failed
+
+    def decode(self, paths, processes):
+        # Yields the try_save_items result for every path in order
+        for path, result in map_jobs(try_save_items, paths, processes):
+            yield result
+
+    def add_items(self, sha1, items, parts):
+        self.db.execute("insert or replace into players values (?, ?)", (sha1, len(items)))
+        self.db.executemany("insert or replace into items values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", items)
+        self.db.executemany("insert or replace into parts values (?, ?, ?, ?, ?, ?)", parts)
+
+    def remove_items(self, sha1):
+        # What add_items got in before it failed
+        for table in ("parts", "items", "players"):
+            self.db.execute("delete from %s where sha1 = ?" % table, (sha1,))
+
+    def add_save(self, path, sha1, st):
+        self.db.execute("insert or replace into saves values (?, ?, ?, ?)", (path, sha1, st.st_size, st.st_mtime))
+
+    def remove_save(self, path):
+        self.db.execute("delete from saves where path = ?", (path,))
+
+    def prune(self):
+        # Forgets saves whose files are gone, returning how many
+        missing = [(path,) for (path,) in self.db.execute("select path from saves") if not os.path.isfile(path)]
+        self.db.executemany("delete from saves where path = ?", missing)
+        self.remove_orphans()
+        self.db.commit()
+        return len(missing)
+
+    def remove_orphans(self):
+        # Items of saves no path points at any more
+        for table in ("parts", "items", "players"):
+            self.db.execute("delete from %s where sha1 not in (select sha1 from saves)" % table)
+
+    def query(self, level=None, item_set=None, type=None, balance=None, manufacturer=None, parts=(),
+              field=None, is_weapon=None):
+        # Yields (path, field, position, is_weapon, level, set, type, balance,
+        # manufacturer) for every matching item of every save, with ids as
+        # (lib, asset). level is a (low, high) range, ids are (lib,) or (lib,
+        # asset), and every one of parts has to be in the item.
+        where = []
+        params = []
+        if level is not None:
+            where.append("items.level between ? and ?")
+            params.extend(level)
+        if item_set is not None:
+            where.append("items.item_set = ?")
+            params.append(item_set)
+        for name, value in (("type", type), ("balance", balance), ("manufacturer", manufacturer)):
+            if value is None:
+                continue
+            where.append("items.%s_lib = ?" % name)
+            params.append(value[0])
+            if len(value) > 1:
+                where.append("items.%s_asset = ?" % name)
+                params.append(value[1])
+        for part in parts:
+            condition = "parts.lib = ?" if len(part) == 1 else "parts.lib = ? and parts.asset = ?"
+            where.append(
+                "exists (select 1 from parts where parts.sha1 = items.sha1 and parts.field = items.field"
+                " and parts.position = items.position and %s)" % condition
+            )
+            params.extend(part)
+        if field is not None:
+            where.append("items.field = ?")
+            params.append(field)
+        if is_weapon is not None:
+            where.append("items.is_weapon = ?")
+            params.append(int(is_weapon))
+        sql = (
+            "select saves.path, items.field, items.position, items.is_weapon, items.level, items.item_set,"
+            " items.type_lib, items.type_asset, items.balance_lib, items.balance_asset,"
+            " items.manufacturer_lib, items.manufacturer_asset"
+            " from items join saves on saves.sha1 = items.sha1"
+        )
+        if where:
+            sql = sql + " where " + " and ".join(where)
+        sql = sql + " order by saves.path, items.field, items.position"
+        for row in self.db.execute(sql, params):
+            yield row[: 6] + ((row[6], row[7]), (row[8], row[9]), (row[10], row[11]))
+
+    def stats(self):
+        return [
+            self.db.execute("select count(*) from %s" % table).fetchone()[0]
+            for table in ("saves", "players", "items")
+        ]
+
+
+def main():
+    p = optparse.OptionParser(usage="%prog [options] DATABASE [save, directory or glob ...]")
+    p.add_option(
+        "--jobs", metavar="N", type="int", default=1,
+        help="number of processes decoding saves, 0 for one per CPU"
+    )
+    p.add_option(
+        "--prune", action="store_true",
+        help="forget saves whose files no longer exist"
+    )
+    p.add_option(
+        "-v", "--verbose", action="store_true",
+        help="print a line for every save indexed"
+    )
+    p.add_option(
+        "-l", "--level", metavar="LEVEL",
+        help="find items of a level, or of a range like 70-72"
+    )
+    p.add_option(
+        "-s", "--set", metavar="SET", dest="item_set", type="int",
+        help="find items of a set"
+    )
+    p.add_option(
+        "-t", "--type", metavar="LIB[:ASSET]",
+        help="find items of a type"
+    )
+    p.add_option(
+        "-b", "--balance", metavar="LIB[:ASSET]",
+        help="find items with a balance"
+    )
+    p.add_option(
+        "-m", "--manufacturer", metavar="LIB[:ASSET]",
+        help="find items from a manufacturer"
+    )
+    p.add_option(
+        "-p", "--part", metavar="LIB[:ASSET]", dest="parts", action="append", default=[],
+        help="find items with a part, may be repeated to require several"
+    )
+    p.add_option(
+        "-f", "--field", choices=sorted(item_field_names.values()),
+        help="only find items in the bank, items or weapons"
+    )
+    p.add_option(
+        "-w", "--weapons", dest="is_weapon", action="store_true",
+        help="only find weapons"
+    )
+    p.add_option(
+        "-g", "--gear", dest="is_weapon", action="store_false",
+        help="only find items that are not weapons"
+    )
+    p.add_option(
+        "-c", "--count", action="store_true",
+        help="print the number of matching items in each save rather than the items"
+    )
+    options, args = p.parse_args()
+    if not args:
+        p.error("No database given")
+
+    index = ItemIndex(args[0])
+    try:
+        if options.prune:
+            print >> sys.stderr, "Pruned %d saves" % index.prune()
+        if len(args) > 1:
+            def report(ok, path, message):
+                if options.verbose or not ok:
+                    print >> sys.stderr, "%s\t%s\t%s" % ("ok" if ok else "error", path, message)
+
+            decoded, skipped, failed = index.update(save_paths(args[1:]), options.jobs, report)
+            print >> sys.stderr, "%d saves indexed, %d unchanged, %d failed" % (decoded, skipped, failed)
+
+        searching = [
+            options.level, options.item_set, options.type, options.balance, options.manufacturer,
+            options.field, options.is_weapon
+        ]
+        if options.parts or any(option is not None for option in searching):
+            fields = dict((name, field) for (field, name) in item_field_names.items())
+            matches = index.query(
+                level=parse_range(options.level) if options.level else None,
+                item_set=options.item_set,
+                type=parse_id(options.type) if options.type else None,
+                balance=parse_id(options.balance) if options.balance else None,
+                manufacturer=parse_id(options.manufacturer) if options.manufacturer else None,
+                parts=map(parse_id, options.parts),
+                field=fields.get(options.field),
+                is_weapon=options.is_weapon
+            )
+            if options.count:
+                for path, rows in itertools.groupby(matches, lambda row: row[0]):
+                    print "%d\t%s" % (sum(1 for _ in rows), path)
+            else:
+                for path, field, position, is_weapon, level, item_set, type, balance, manufacturer in matches:
+                    # Items cut short before their level have none
+                    if level is None:
+                        level = "?"
+                    print "%s\t%s\t%d\t%s\t%s\tset=%d\ttype=%d:%d\tbalance=%d:%d\tmanufacturer=%d:%d" % (
+                        path, item_field_names[field], position, "weapon" if is_weapon else "item", level,
+                        item_set, type[0], type[1], balance[0], balance[1], manufacturer[0], manufacturer[1]
+                    )
+        elif len(args) == 1 and not options.prune:
+            print "%d saves, %d distinct, %d items" % tuple(index.stats())
+    except ValueError as e:
+        p.error(str(e))
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import json
+import resource
+import time
+
+# Callables given a record for every stage of the codec that finishes, see
+# add_hook. While it is empty stages cost a list check each.
+hooks = []
+
+
+def add_hook(hook):
+    # hook is called with a dict of the stage name, its wall time in seconds,
+    # the bytes it read and wrote, None where they aren't known, and how many
+    # KB the stage raised the process's peak resident size by. The peak only
+    # ever grows, so a stage that allocates less than some earlier one shows 0.
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def start():
+    # The start time and peak resident size of a stage, or None when nothing
+    # is listening
+    if hooks:
+        return time.time(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None
+
+
+def finish(started, stage, bytes_in=None, bytes_out=None):
+    if started is None:
+        return
+    started_time, started_peak = started
+    record = {
+        "stage": stage, "seconds": time.time() - started_time, "bytes_in": bytes_in, "bytes_out": bytes_out,
+        "peak_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - started_peak
+    }
+    for hook in list(hooks):
+        hook(record)
+
+
+class Recorder(object):
+    # A hook that keeps the records of one save and writes them out as a
+    # table or as JSON lines
+
+    def __init__(self, label="-"):
+        self.label = label
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def write(self, output, format="table"):
+        if format == "json":
+            for record in self.records:
+                record = dict(record, save=self.label)
+                print >> output, json.dumps(record, sort_keys=True)
+            return
+        print >> output, self.label
+        print >> output, "    %-20s %10s %12s %12s %10s" % ("stage", "seconds", "bytes in", "bytes out", "peak +KB")
+        for record in self.records:
+            print >> output, "    %-20s %10.4f %12s %12s %10d" % (
+                record["stage"], record["seconds"], size_text(record["bytes_in"]),
+                size_text(record["bytes_out"]), record["peak_growth_kb"]
+            )
+        print >> output, "    %-20s %10.4f" % ("total", sum(r["seconds"] for r in self.records))
+
+
+def size_text(size):
+    return "-" if size is None else str(size)
@@ -1,14 +1,34 @@
+import binascii
+import copy
+import glob
 import json
 import optparse
+import os
 import sys
+import time
 
-from data import modify_save, export_items, import_items, apply_structure, remove_structure, invert_structure
-from presents import unwrap_player_data, save_structure, wrap_player_data
-from read import read_protobuf
+import instrument
+from cache import PlayerCache
+from data import modify_save, parse_changes, export_items, import_items, dump_json, remove_structure, invert_structure
+from pool import map_jobs
+from presents import unwrap_player_data, save_structure, wrap_player_data, use_player_cache
+from read import MessageView
 from write import write_protobuf
 
 
+# The file name extension batch mode gives the output of each operation
+batch_extensions = {
+    "decode": ".pb", "json": ".json", "modify": ".sav", "export": ".txt", "import": ".sav", "encode": ".sav"
+}
+
+
 def main():
+    if options.cache:
+        use_player_cache(PlayerCache(options.cache))
+
+    if options.batch:
+        return batch()
+
     if len(args) >= 2 and args[0] != "-" and args[0] == args[1]:
         print >> sys.stderr, "Cannot overwrite the save file, please use a different filename for the new save."
         return
@@ -23,41 +43,207 @@ def main():
     else:
         output = open(args[1], "wb")
 
+    op = operation(options)
+    if op == "export":
+        output = open(options.export_items, "w")
+    recorder = start_profile(options)
+    convert(op, input.read(), output, options)
+    finish_profile(recorder, args[0] if args else "-", options)
+
+
+def operation(options):
     if options.modify is not None:
-        changes = {}
-        if options.modify:
-            for m in options.modify.split(","):
-                k, v = (m.split("=", 1) + [None])[: 2]
-                changes[k] = v
-        output.write(modify_save(input.read(), changes))
+        return "modify"
     elif options.export_items:
-        output = open(options.export_items, "w")
-        export_items(input.read(), output)
+        return "export"
     elif options.import_items:
-        itemlist = open(options.import_items, "r")
-        output.write(import_items(input.read(), itemlist.read()))
+        return "import"
     elif options.decode:
-        savegame = input.read()
-        player = unwrap_player_data(savegame)
-        if options.json:
-            data = read_protobuf(player)
-            if options.parse:
-                data = apply_structure(data, save_structure)
-            player = json.dumps(data, encoding="latin1", sort_keys=True, indent=4)
-        output.write(player)
-    else:
-        player = input.read()
+        return "json" if options.json else "decode"
+    return "encode"
+
+
+def convert(op, data, output, options):
+    if op == "modify":
+        output.write(modify_save(data, parse_changes(options.modify), options.level))
+    elif op == "export":
+        export_items(data, output)
+    elif op == "import":
+        itemlist = open(options.import_items, "r")
+        output.write(import_items(data, itemlist.read(), options.level))
+    elif op == "decode" or op == "json":
+        player = unwrap_player_data(data)
+        if op == "json":
+            started = instrument.start()
+            structure = save_structure if options.parse else None
+            dump_json(MessageView(player), output, structure)
+            instrument.finish(started, "json", len(player), None)
+        else:
+            output.write(player)
+    elif op == "encode":
+        player = data
         if options.json:
+            started = instrument.start()
             data = json.loads(player, encoding="latin1")
+            instrument.finish(started, "json", len(player), None)
             if not data.has_key("1"):
+                started = instrument.start()
                 data = remove_structure(data, invert_structure(save_structure))
+                instrument.finish(started, "remove_structure")
+            started = instrument.start()
             player = write_protobuf(data)
-        savegame = wrap_player_data(player)
+            instrument.finish(started, "write_protobuf", None, len(player))
+        savegame = wrap_player_data(player, level=options.level)
         output.write(savegame)
+    else:
+        raise ValueError("Unknown operation " + repr(op))
+
+
+def batch():
+    # Runs every job from a directory, glob or manifest, in this process or
+    # a pool of them, printing a line per job in order and a summary at the
+    # end
+    outdir = args[0] if args else None
+    start = time.time()
+    count = failed = size = 0
+    for job, (ok, message, n) in run_jobs(batch_jobs(options.batch, outdir, options), options.jobs):
+        count = count + 1
+        size = size + n
+        if ok:
+            print "ok\t%s\t%s\t%s" % (job[1], job[2], message)
+        else:
+            failed = failed + 1
+            print "error\t%s\t%s\t%s" % (job[1], job[2], message)
+        sys.stdout.flush()
+    elapsed = max(time.time() - start, 1e-6)
+    print >> sys.stderr, "%d files, %d failed, %.2fs, %.1f files/s, %.2f MB/s" % (
+        count, failed, elapsed, count / elapsed, size / elapsed / 1e6
+    )
+    if failed:
+        sys.exit(1)
+
+
+def batch_jobs(source, outdir, options):
+    # Yields (operation, input, output, options) for every job. A manifest
+    # is a file of JSON objects, one per line, with an op of decode, json,
+    # modify, export, import or encode, an input and an output, and
+    # optionally modify, items, json, parse and level to override the
+    # command line. A line that can't be read is yielded as a job with no
+    # operation, its manifest line as the input and the error in place of
+    # the options, so that it fails on its own. Files in a directory or
+    # matching a glob all get the operation given on the command line, with
+    # outputs in outdir, and an export writes each save's codes to its output
+    # rather than to -e.
+    if os.path.isfile(source) and source.endswith(".jsonl"):
+        for number, line in enumerate(open(source), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                if type(entry) is not dict:
+                    raise ValueError("Expected a JSON object")
+                for key in ("op", "input"):
+                    if key not in entry:
+                        raise ValueError("Missing " + repr(key))
+            except ValueError as e:
+                yield None, "%s:%d" % (source, number), None, "%s: %s" % (type(e).__name__, e)
+                continue
+            job_options = copy.copy(options)
+            job_options.modify = entry.get("modify", options.modify)
+            job_options.import_items = entry.get("items", options.import_items)
+            job_options.parse = entry.get("parse", options.parse)
+            job_options.level = entry.get("level", options.level)
+            job_options.json = entry.get("json", options.json)
+            yield entry["op"], entry["input"], entry.get("output"), job_options
+        return
+
+    if os.path.isdir(source):
+        inputs = sorted(os.path.join(source, name) for name in os.listdir(source))
+        inputs = [name for name in inputs if os.path.isfile(name)]
+    else:
+        inputs = sorted(glob.glob(source))
+    op = operation(options)
+    for input in inputs:
+        output = None
+        if outdir is not None:
+            name = os.path.splitext(os.path.basename(input))[0]
+            output = os.path.join(outdir, name + batch_extensions[op])
+        yield op, input, output, options
+
+
+def run_jobs(jobs, processes=1):
+    # Yields every job with its run_job result, in the order of the jobs.
+    # With several processes the workers read and write the files
+    # themselves, so only paths and short results cross between processes.
+    # Jobs may run in any order, so one should not read another's output.
+    return map_jobs(run_job, jobs, processes)
+
+
+def start_profile(options):
+    if not getattr(options, "profile", None):
+        return None
+    recorder = instrument.Recorder()
+    instrument.add_hook(recorder)
+    return recorder
+
+
+def finish_profile(recorder, label, options):
+    # Writes the stages of a save to stderr
+    if recorder is None:
+        return
+    instrument.remove_hook(recorder)
+    recorder.label = label
+    recorder.write(sys.stderr, options.profile)
+
+
+def run_job(job):
+    # Returns whether the job worked, its time or error and the input size.
+    # The output is written to a temporary file that only replaces it once
+    # the job has worked, so a failed job leaves nothing behind.
+    op, input, output, job_options = job
+    if op is None:
+        return False, job_options, 0
+    start = time.time()
+    try:
+        if output is None:
+            raise ValueError("No output given")
+        if os.path.abspath(input) == os.path.abspath(output):
+            raise ValueError("Cannot overwrite the input file")
+        data = open(input, "rb").read()
+        fd, temp = create_temp(output)
+        recorder = start_profile(job_options)
+        try:
+            with os.fdopen(fd, "w" if op == "export" else "wb") as f:
+                convert(op, data, f, job_options)
+            os.rename(temp, output)
+        except Exception:
+            os.remove(temp)
+            raise
+        finally:
+            finish_profile(recorder, input, job_options)
+    except Exception as e:
+        return False, "%s: %s" % (type(e).__name__, e), 0
+    return True, "%.3fs" % (time.time() - start), len(data)
+
+
+def create_temp(output):
+    # A new file beside output, made with the mode open would give it so the
+    # umask applies as usual
+    temp = "%s.%s.tmp" % (os.path.abspath(output), binascii.hexlify(os.urandom(6)))
+    return os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), temp
 
 
 def parse_args():
-    p = optparse.OptionParser()
+    p = optparse.OptionParser(usage="%prog [options] [input [output]]\n       %prog [options] -b SOURCE [outdir]")
+    p.add_option(
+        "-b", "--batch", metavar="SOURCE",
+        help="run on every save in a directory or glob, writing to outdir, or on every job in a .jsonl manifest"
+    )
+    p.add_option(
+        "-c", "--cache", metavar="DIRECTORY",
+        help="keep decoded saves in a directory and reuse them while the save is unchanged"
+    )
     p.add_option(
         "-d", "--decode",
         action="store_true",
@@ -76,10 +262,22 @@ def parse_args():
         action="store_true",
         help="read or write save game data in JSON format, rather than raw protobufs"
     )
+    p.add_option(
+        "--jobs", metavar="N", type="int", default=1,
+        help="number of processes for batch mode, 0 for one per CPU"
+    )
+    p.add_option(
+        "-l", "--level", type="int", default=1,
+        help="LZO compression level for new save games, 2-9 compress harder but are slower"
+    )
     p.add_option(
         "-m", "--modify", metavar="MODIFICATIONS",
         help="comma separated list of modifications to make, eg money=99999999,eridium=99"
     )
+    p.add_option(
+        "--profile", metavar="FORMAT", choices=["table", "json"],
+        help="report the time, sizes and peak memory growth of every stage to stderr, as a table or as json lines"
+    )
     p.add_option(
         "-p", "--parse",
         action="store_true",
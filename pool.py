@@ -0,0 +1,30 @@
+import itertools
+import multiprocessing
+import random
+
+
+def map_jobs(func, jobs, processes=1):
+    # Yields every job with func's result for it, in the order of the jobs.
+    # With several processes, processes of 0 meaning one per CPU, func has
+    # to be a module level function whose argument and result pickle, and
+    # jobs are handed out in chunks so that many small ones don't wait on
+    # the pool for each one. Jobs may run in any order.
+    if processes == 0:
+        processes = multiprocessing.cpu_count()
+    if processes > 1:
+        jobs = list(jobs)
+    if processes <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield job, func(job)
+        return
+    chunksize = max(1, min(32, len(jobs) // (processes * 4)))
+    # Forked workers would otherwise share the random state import_items
+    # draws item keys from
+    pool = multiprocessing.Pool(processes, random.seed)
+    try:
+        for result in itertools.izip(jobs, pool.imap(func, jobs, chunksize)):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
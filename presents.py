@@ -2,60 +2,146 @@ import binascii
 import hashlib
 import struct
 
-from compress import compress, decompress
-from data import xor_data, rotate_data_left, rotate_data_right
+import instrument
+from compress import compress, decompress_into, decompressed_size, check_decompressed_size
 from error import ERRNO
-from read import ReadBitstream, read_repeated_protobuf_value
+from read import ReadBitstream, read_protobuf, read_repeated_protobuf_value
 from table import item_header_sizes, black_market_keys, item_sizes
 from tree import *
-from write import WriteBitstream, write_repeated_protobuf_value
+from write import WriteBitstream, write_protobuf, write_repeated_protobuf_value
+
+item_fields = (41, 53, 54)
+
+# Bit offset of the start of every item field, and of the end of the last
+item_offsets = tuple(tuple(sum(sizes[: i]) for i in xrange(len(sizes) + 1)) for sizes in item_sizes)
+item_layouts = {}
+
+keystreams = {}
+old_keystreams = {}
+keystream_cache_size = 1024
+
+# A cache.PlayerCache unwrap_player_data looks saves up in, if any
+player_cache = None
+
+
+def rotate_data_right(data, steps):
+    steps = steps % len(data)
+    return data[-steps:] + data[: -steps]
+
+
+def rotate_data_left(data, steps):
+    steps = steps % len(data)
+    return data[steps:] + data[: steps]
+
+
+def xor_data(data, key):
+    return xor_data_many([data], [key])[0]
+
+
+def xor_data_many(chunks, keys):
+    # Every chunk is XORed against its own keystream in one integer operation
+    data = "".join(chunks)
+    n = len(data)
+    if n == 0:
+        return list(chunks)
+    stream = "".join([keystream(key, len(c))[: len(c)] for (c, key) in zip(chunks, keys)])
+    value = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(stream), 16)
+    data = binascii.unhexlify("%0*x" % (n * 2, value))
+    output = []
+    i = 0
+    for c in chunks:
+        output.append(data[i: i + len(c)])
+        i = i + len(c)
+    return output
+
+
+def keystream(key, n):
+    # Exports recode every item with key 0, so recently used streams are kept.
+    # Streams live in a young and an old generation, a lookup that hits the
+    # old one moves the stream back to the young one and a full young
+    # generation replaces the old one, which approximates an LRU without the
+    # bookkeeping of OrderedDict.
+    global old_keystreams, keystreams
+    stream = keystreams.get(key)
+    if stream is None:
+        stream = old_keystreams.get(key)
+        if len(keystreams) >= keystream_cache_size:
+            old_keystreams = keystreams
+            keystreams = {}
+    if stream is None or len(stream) < n:
+        stream = make_keystream(key, max(n, 64))
+    keystreams[key] = stream
+    return stream
+
+
+def make_keystream(key, n):
+    key = key & 0xffffffff
+    stream = bytearray(n)
+    for i in xrange(n):
+        key = (key * 279470273) % 4294967291
+        stream[i] = key & 0xff
+    return str(stream)
+
+
+def item_layout(is_weapon, length):
+    # Bit offset and mask of every field for an item of length bytes. Fields
+    # that run past the end of a truncated item are None and do not advance
+    # the offset, as unpack_item_values has always treated them.
+    layout = item_layouts.get((is_weapon, length))
+    if layout is None:
+        layout = []
+        i = 0
+        for size in item_sizes[is_weapon]:
+            if i + size > length * 8:
+                layout.append(None)
+                continue
+            layout.append((i, (1 << size) - 1))
+            i = i + size
+        layout = item_layouts[(is_weapon, length)] = tuple(layout)
+    return layout
 
 
 def pack_item_values(is_weapon, values):
+    offsets = item_offsets[is_weapon]
+    value = 0
     i = 0
-    input_bytes = [0] * 32
-    for value, size in zip(values, item_sizes[is_weapon]):
-        if value is None:
+    for v, offset in zip(values, offsets):
+        if v is None:
             break
-        j = i >> 3
-        value = value << (i & 7)
-        while value != 0:
-            input_bytes[j] |= value & 0xff
-            value = value >> 8
-            j = j + 1
-        i = i + size
-    if (i & 7) != 0:
-        value = 0xff << (i & 7)
-        input_bytes[i >> 3] |= (value & 0xff)
-    return "".join(map(chr, input_bytes[: (i + 7) >> 3]))
+        value |= v << offset
+        i = i + 1
+    i = offsets[i]
+    n = (i + 7) >> 3
+    if n == 0:
+        return ""
+    # Unused bits of the last byte are set
+    value = (value | (0xff << i)) & ((1 << (n * 8)) - 1)
+    return binascii.unhexlify("%0*x" % (n * 2, value))[::-1]
 
 
 def unpack_item_values(is_weapon, data):
-    i = 8
-    data = " " + data
-    values = []
-    end = len(data) * 8
-    for size in item_sizes[is_weapon]:
-        j = i + size
-        if j > end:
-            values.append(None)
-            continue
-        value = 0
-        for b in data[j >> 3: (i >> 3) - 1: -1]:
-            value = (value << 8) | ord(b)
-        values.append((value >> (i & 7)) & ~ (0xff << size))
-        i = j
-    return values
+    layout = item_layout(is_weapon, len(data))
+    value = int(binascii.hexlify(data[::-1]), 16) if data else 0
+    return [(value >> field[0]) & field[1] if field else None for field in layout]
 
 
 def wrap_item(is_weapon, values, key):
     item = pack_item_values(is_weapon, values)
-    header = struct.pack(">Bi", (is_weapon << 7) | 7, key)
-    padding = "\xff" * (33 - len(item))
-    h = binascii.crc32(header + "\xff\xff" + item + padding) & 0xffffffff
-    checksum = struct.pack(">H", ((h >> 16) ^ h) & 0xffff)
-    body = xor_data(rotate_data_left(checksum + item, key & 31), key >> 5)
-    return header + body
+    return wrap_raw_items([chr((is_weapon << 7) | 7)], [item], [key])[0]
+
+
+def wrap_raw_items(versions, items, keys):
+    headers = []
+    bodies = []
+    for version, item, key in zip(versions, items, keys):
+        header = version + struct.pack(">i", key)
+        padding = "\xff" * (33 - len(item))
+        h = binascii.crc32(header + "\xff\xff" + item + padding) & 0xffffffff
+        checksum = struct.pack(">H", ((h >> 16) ^ h) & 0xffff)
+        headers.append(header)
+        bodies.append(rotate_data_left(checksum + item, key & 31))
+    bodies = xor_data_many(bodies, [key >> 5 for key in keys])
+    return [header + body for (header, body) in zip(headers, bodies)]
 
 
 def unwrap_item(data):
@@ -65,6 +151,76 @@ def unwrap_item(data):
     return is_weapon, unpack_item_values(is_weapon, raw[2:]), key
 
 
+def unwrap_items(player, fields=item_fields, unpack=True):
+    # Decodes every item stored in the given fields of a read_protobuf player
+    # or MessageView into columns with one row per item. The entry and
+    # message columns point back into the player so rows can be stored
+    # again, and without unpack only the raw item data is decoded. Item
+    # messages are a few dozen bytes, too small for a MessageView to pay off.
+    batch = {
+        "field": [], "entry": [], "message": [], "version": [], "is_weapon": [],
+        "key": [], "data": [], "set": [], "type": [], "balance": [],
+        "manufacturer": [], "level": [], "parts": []
+    }
+    raws = []
+    for field in fields:
+        for entry in player.get(field, []):
+            message = read_protobuf(entry[1])
+            raws.append(message[1][0][1])
+            batch["field"].append(field)
+            batch["entry"].append(entry)
+            batch["message"].append(message)
+
+    keys = [struct.unpack(">i", raw[1: 5])[0] for raw in raws]
+    bodies = xor_data_many([raw[5:] for raw in raws], [key >> 5 for key in keys])
+    for raw, key, body in zip(raws, keys, bodies):
+        is_weapon = ord(raw[0]) >> 7
+        data = rotate_data_right(body, key & 31)[2:]
+        batch["version"].append(raw[0])
+        batch["is_weapon"].append(is_weapon)
+        batch["key"].append(key)
+        batch["data"].append(data)
+        if not unpack:
+            continue
+        values = unpack_item_values(is_weapon, data)
+        batch["set"].append(values[0])
+        batch["type"].append(values[1])
+        batch["balance"].append(values[2])
+        batch["manufacturer"].append(values[3])
+        batch["level"].append(values[4: 6])
+        batch["parts"].append(values[6:])
+    return batch
+
+
+def item_values(batch, row):
+    values = [batch["set"][row], batch["type"][row], batch["balance"][row], batch["manufacturer"][row]]
+    return values + batch["level"][row] + batch["parts"][row]
+
+
+def wrap_items(batch, rows):
+    # Packs rows again from their column values
+    versions, items, keys = [], [], []
+    for row in rows:
+        is_weapon = batch["is_weapon"][row]
+        versions.append(chr((is_weapon << 7) | 7))
+        items.append(pack_item_values(is_weapon, item_values(batch, row)))
+        keys.append(batch["key"][row])
+    return wrap_raw_items(versions, items, keys)
+
+
+def rekey_items(batch, key):
+    # Re-encrypts every row's original item bytes under a new key
+    rows = xrange(len(batch["data"]))
+    return wrap_raw_items(batch["version"], batch["data"], [key for _ in rows])
+
+
+def store_items(batch, rows, raws):
+    for row, raw in zip(rows, raws):
+        message = batch["message"][row]
+        message[1][0][1] = raw
+        batch["entry"][row][1] = write_protobuf(message)
+
+
 def unwrap_bytes(value):
     return [ord(d) for d in value]
 
@@ -121,45 +277,107 @@ def wrap_item_info(value):
     return wrap_item(value["is_weapon"], item, value["key"])
 
 
+def use_player_cache(cache):
+    global player_cache
+    player_cache = cache
+
+
 def unwrap_player_data(data):
-    if data[: 20] != hashlib.sha1(data[20:]).digest():
-        raise ERRNO("Invalid save file")
+    return unwrap_player_tree(data)[0]
 
-    data = decompress("\xf0" + data[20:])
-    size, wsg, version = struct.unpack(">I3sI", data[: 11])
+
+def unwrap_player_tree(data):
+    # The player and the Huffman tree it was encoded with, which
+    # wrap_player_data can reuse for an edited player. The tree is None when
+    # the player came from the cache.
+    started = instrument.start()
+    if data[: 20] != hashlib.sha1(buffer(data, 20)).digest():
+        raise ERRNO("Invalid save file")
+    instrument.finish(started, "sha1", len(data) - 20, 20)
+
+    if player_cache is not None:
+        started = instrument.start()
+        player = player_cache.get(data[: 20])
+        instrument.finish(started, "cache", 20, player and len(player))
+        if player is not None:
+            return player, None
+
+    # The save holds the LZO size field at offset 20, decompress straight
+    # into a buffer and let the Huffman decoder read from a view of it
+    started = instrument.start()
+    raw = bytearray(decompressed_size(data, 20))
+    check_decompressed_size(len(raw), decompress_into(data, raw, 20))
+    instrument.finish(started, "lzo_decompress", len(data) - 20, len(raw))
+    size, wsg, version = struct.unpack_from(">I3sI", raw)
     if version != 2 and version != 0x02000000:
         raise ERRNO("Unknown save version " + str(version))
 
     if version == 2:
-        crc, size = struct.unpack(">II", data[11: 19])
+        crc, size = struct.unpack_from(">II", raw, 11)
     else:
-        crc, size = struct.unpack("<II", data[11: 19])
+        crc, size = struct.unpack_from("<II", raw, 11)
 
-    bitstream = ReadBitstream(data[19:])
+    started = instrument.start()
+    bitstream = ReadBitstream(memoryview(raw)[19:])
     tree = read_huffman_tree(bitstream)
+    instrument.finish(started, "huffman_tree", bitstream.i >> 3, None)
+    # Every symbol takes at least a bit, so a larger size can only come from
+    # a corrupt save
+    if size > ((len(raw) - 19) << 3) - bitstream.i:
+        raise ERRNO("Invalid player size " + str(size))
+    started = instrument.start()
     player = huffman_decompress(tree, bitstream, size)
+    instrument.finish(started, "huffman_decode", len(raw) - 19, len(player))
 
+    started = instrument.start()
     if (binascii.crc32(player) & 0xffffffff) != crc:
         raise ERRNO("CRC check failed")
+    instrument.finish(started, "crc", len(player), 4)
 
-    return player
+    if player_cache is not None:
+        player_cache.put(data[: 20], player)
+    return player, tree
 
 
-def wrap_player_data(player):
+def wrap_player_data(player, frequencies=None, level=1, tree=None):
+    started = instrument.start()
     crc = binascii.crc32(player) & 0xffffffff
-
+    instrument.finish(started, "crc", len(player), 4)
+
+    # A tree from unwrap_player_tree is kept as long as it has a code for
+    # every byte of the player, which saves counting and building a new one
+    # after small edits
+    started = instrument.start()
+    encoding = None
+    if tree is not None:
+        encoding = make_encode_table(tree)
+        for c in set(player):
+            if encoding[ord(c)] is None:
+                encoding = None
+                break
+    if encoding is None:
+        tree = make_huffman_tree(player, frequencies)
+        encoding = make_encode_table(tree)
     bitstream = WriteBitstream()
-    tree = make_huffman_tree(player)
     write_huffman_tree(tree, bitstream)
-    huffman_compress(invert_tree(tree), player, bitstream)
+    instrument.finish(started, "huffman_tree", len(player), len(bitstream.buffer))
+    started = instrument.start()
+    huffman_compress(encoding, player, bitstream)
     data = bitstream.getvalue() + "\x00\x00\x00\x00"
+    instrument.finish(started, "huffman_encode", len(player), len(data))
 
     header = struct.pack(">I3s", len(data) + 15, "WSG")
     header = header + struct.pack("<III", 2, crc, len(player))
 
-    data = compress(header + data)[1:]
+    started = instrument.start()
+    size = len(header) + len(data)
+    data = compress(header + data, level)[1:]
+    instrument.finish(started, "lzo_compress", size, len(data))
 
-    return hashlib.sha1(data).digest() + data
+    started = instrument.start()
+    data = hashlib.sha1(data).digest() + data
+    instrument.finish(started, "sha1", len(data) - 20, 20)
+    return data
 
 
 def unwrap_black_market(value):
@@ -1,43 +1,129 @@
 import struct
 
-from cStringIO import StringIO
 from error import ERRNO
+from write import write_protobuf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Packed varint fields at least this long are decoded with NumPy when it
+# is installed
+numpy_packed_size = 4096
+
+unpack_long = struct.Struct(">q").unpack_from
 
 
 class ReadBitstream(object):
 
     def __init__(self, s):
         self.s = s
-        self.i = 0
+        self.view = memoryview(s)
+        self.size = len(s)
+        self.pos = 0
+        self.acc = 0
+        self.nacc = 0
+        # How many of the low bits of acc are padding from past the end
+        self.floor = 0
+
+    @property
+    def i(self):
+        return (self.pos << 3) - self.nacc
+
+    @i.setter
+    def i(self, i):
+        self.pos = i >> 3
+        self.acc = 0
+        self.nacc = 0
+        self.floor = 0
+        self.consume(i & 7)
+
+    def refill(self):
+        # Reloads acc from the eight bytes holding its remaining bits and
+        # the ones after them, signed so that it stays a machine int; near
+        # the end it loads 32 more bits instead, which past the end of the
+        # data read as zero
+        pos = self.pos
+        nacc = self.nacc
+        start = pos - ((nacc + 7) >> 3)
+        if nacc <= 56 and start + 8 <= self.size:
+            self.acc = unpack_long(self.s, start)[0]
+            self.nacc = nacc + ((start + 8 - pos) << 3)
+            self.pos = start + 8
+            return
+        acc = self.acc & ((1 << nacc) - 1)
+        for j in xrange(pos, pos + 4):
+            acc = acc << 8
+            if j < self.size:
+                acc = acc | ord(self.view[j])
+            else:
+                self.floor = self.floor + 8
+        self.acc = acc
+        self.nacc = nacc + 32
+        self.pos = pos + 4
+
+    def peek(self, n):
+        while self.nacc < n:
+            self.refill()
+        return (self.acc >> (self.nacc - n)) & ((1 << n) - 1)
+
+    def consume(self, n):
+        while self.nacc < n:
+            self.refill()
+        self.nacc = self.nacc - n
+        if self.pos > self.size and (self.pos << 3) - self.nacc > (self.size << 3):
+            raise ERRNO("Truncated bitstream")
+
+    def align(self):
+        self.consume(self.nacc & 7)
+
+    # The readers take bits straight from the accumulator while it holds
+    # enough of them above the padding, refilling it once when it doesn't,
+    # and only go through peek and consume near the end of the data
 
     def read_bit(self):
-        i = self.i
-        self.i = i + 1
-        byte = ord(self.s[i >> 3])
-        bit = byte >> (7 - (i & 7))
-        return bit & 1
+        nacc = self.nacc - 1
+        if nacc < self.floor:
+            self.refill()
+            nacc = self.nacc - 1
+            if nacc < self.floor:
+                value = self.peek(1)
+                self.consume(1)
+                return value
+        self.nacc = nacc
+        return (self.acc >> nacc) & 1
 
     def read_bits(self, n):
-        s = self.s
-        i = self.i
-        end = i + n
-        chunk = s[i >> 3: (end + 7) >> 3]
-        value = ord(chunk[0]) & ~ (0xff00 >> (i & 7))
-        for c in chunk[1:]:
-            value = (value << 8) | ord(c)
-        if (end & 7) != 0:
-            value = value >> (8 - (end & 7))
-        self.i = end
+        nacc = self.nacc - n
+        if nacc < self.floor and n <= 32:
+            self.refill()
+            nacc = self.nacc - n
+        if nacc >= self.floor:
+            self.nacc = nacc
+            return (self.acc >> nacc) & ((1 << n) - 1)
+        value = 0
+        while n > 32:
+            value = (value << 32) | self.read_bits(32)
+            n = n - 32
+        value = (value << n) | self.peek(n)
+        self.consume(n)
         return value
 
     def read_byte(self):
-        i = self.i
-        self.i = i + 8
-        byte = ord(self.s[i >> 3])
-        if (i & 7) == 0:
-            return byte
-        byte = (byte << 8) | ord(self.s[(i >> 3) + 1])
-        return (byte >> (8 - (i & 7))) & 0xff
+        nacc = self.nacc - 8
+        if nacc < self.floor:
+            pos = self.pos
+            start = pos - ((nacc + 15) >> 3)
+            if start + 8 > self.size:
+                value = self.peek(8)
+                self.consume(8)
+                return value
+            self.acc = unpack_long(self.s, start)[0]
+            self.pos = start + 8
+            nacc = nacc + ((start + 8 - pos) << 3)
+        self.nacc = nacc
+        return (self.acc >> nacc) & 0xff
 
 
 def read_varint(f):
@@ -52,15 +138,29 @@ def read_varint(f):
     return value
 
 
+def decode_varint(data, pos):
+    # Reads the varint at index pos of a buffer, returning it and the index
+    # after it
+    value = 0
+    offset = 0
+    while 1:
+        b = ord(data[pos])
+        pos = pos + 1
+        value |= (b & 0x7f) << offset
+        if (b & 0x80) == 0:
+            return value, pos
+        offset = offset + 7
+
+
 def read_protobuf(data):
     fields = {}
     end_position = len(data)
-    bytestream = StringIO(data)
-    while bytestream.tell() < end_position:
-        key = read_varint(bytestream)
+    pos = 0
+    while pos < end_position:
+        key, pos = decode_varint(data, pos)
         field_number = key >> 3
         wire_type = key & 7
-        value = read_protobuf_value(bytestream, wire_type)
+        value, pos = decode_protobuf_value(data, pos, wire_type)
         fields.setdefault(field_number, []).append([wire_type, value])
     return fields
 
@@ -80,9 +180,299 @@ def read_protobuf_value(b, wire_type):
     return value
 
 
+def decode_protobuf_value(data, pos, wire_type):
+    # read_protobuf_value for the value at index pos of a buffer, returning
+    # it and the index after it
+    if wire_type == 0:
+        return decode_varint(data, pos)
+    elif wire_type == 1:
+        return struct.unpack_from("<Q", data, pos)[0], pos + 8
+    elif wire_type == 2:
+        length, pos = decode_varint(data, pos)
+        return data[pos: pos + length], pos + length
+    elif wire_type == 5:
+        return struct.unpack_from("<I", data, pos)[0], pos + 4
+    else:
+        raise ERRNO("Unsupported wire type " + str(wire_type))
+
+
 def read_repeated_protobuf_value(data, wire_type):
-    b = StringIO(data)
+    return decode_packed(data, wire_type)
+
+
+def decode_packed(data, wire_type):
+    # Decodes every value of a packed repeated field in one go
+    if wire_type == 0:
+        if numpy is not None and len(data) >= numpy_packed_size:
+            return decode_packed_numpy(data)
+        return decode_packed_varints(data)
+    elif wire_type == 1 or wire_type == 5:
+        size, code = (8, "Q") if wire_type == 1 else (4, "I")
+        if len(data) % size != 0:
+            raise ERRNO("Truncated packed field")
+        return list(struct.unpack("<%d%s" % (len(data) // size, code), data))
     values = []
-    while b.tell() < len(data):
-        values.append(read_protobuf_value(b, wire_type))
+    pos = 0
+    while pos < len(data):
+        value, pos = decode_protobuf_value(data, pos, wire_type)
+        values.append(value)
     return values
+
+
+def decode_packed_varints(data):
+    data = bytearray(data)
+    if len(data) == 0:
+        return []
+    if max(data) < 0x80:
+        return list(data)
+    values = []
+    value = 0
+    offset = 0
+    for b in data:
+        value |= (b & 0x7f) << offset
+        if b < 0x80:
+            values.append(value)
+            value = 0
+            offset = 0
+        else:
+            offset = offset + 7
+    if offset != 0:
+        raise ERRNO("Truncated varint")
+    return values
+
+
+def decode_packed_numpy(data):
+    # Every byte is shifted into place by its position in its varint and the
+    # varints are summed, which only holds while they fit in 63 bits
+    b = numpy.frombuffer(data, numpy.uint8)
+    ends = numpy.flatnonzero(b < 0x80)
+    if len(ends) == 0 or ends[-1] != len(b) - 1:
+        raise ERRNO("Truncated varint")
+    starts = numpy.concatenate(([0], ends[: -1] + 1))
+    lengths = ends - starts + 1
+    if lengths.max() > 9:
+        return decode_packed_varints(data)
+    shifts = (numpy.arange(len(b)) - numpy.repeat(starts, lengths)) * 7
+    parts = (b & 0x7f).astype(numpy.int64) << shifts
+    return numpy.add.reduceat(parts, starts).tolist()
+
+
+class MessageView(object):
+    # A protobuf message read lazily from a buffer. One scan records where
+    # every field is, values are only decoded when a field is read, nested
+    # messages are views over the same buffer, and tobytes splices the
+    # original bytes of every field that has not been changed. Reading a
+    # field gives the [[wire_type, value], ...] list read_protobuf would,
+    # which can be changed in place the same way.
+
+    def __init__(self, data, start=0, end=None):
+        self.data = data
+        self.view = memoryview(data)
+        self.start = start
+        self.end = len(data) if end is None else end
+        # Every occurrence of a field as (wire_type, start, value start, end)
+        self.spans = {}
+        self.fields = {}
+        self.originals = {}
+        self.children = {}
+        self.removed = set()
+        self.scan()
+
+    def scan(self):
+        data = self.data
+        pos = self.start
+        end = self.end
+        spans = self.spans
+        try:
+            while pos < end:
+                start = pos
+                key, pos = decode_varint(data, pos)
+                field_number = key >> 3
+                wire_type = key & 7
+                value_start = pos
+                if wire_type == 0:
+                    pos = decode_varint(data, pos)[1]
+                elif wire_type == 1:
+                    pos = pos + 8
+                elif wire_type == 2:
+                    length, value_start = decode_varint(data, pos)
+                    pos = value_start + length
+                elif wire_type == 5:
+                    pos = pos + 4
+                else:
+                    raise ERRNO("Unsupported wire type " + str(wire_type))
+                spans.setdefault(field_number, []).append((wire_type, start, value_start, pos))
+        except IndexError:
+            pos = end + 1
+        if pos > end:
+            raise ERRNO("Truncated protobuf message")
+
+    def decode(self, wire_type, start, end):
+        if wire_type == 0:
+            return decode_varint(self.data, start)[0]
+        elif wire_type == 1:
+            return struct.unpack_from("<Q", self.data, start)[0]
+        elif wire_type == 2:
+            return self.view[start: end].tobytes()
+        else:
+            return struct.unpack_from("<I", self.data, start)[0]
+
+    def original(self, field_number):
+        entries = self.originals.get(field_number)
+        if entries is None:
+            entries = [[w, self.decode(w, a, b)] for (w, _, a, b) in self.spans.get(field_number, [])]
+            self.originals[field_number] = entries
+        return entries
+
+    def read(self, field_number):
+        # The field's entries decoded from the original bytes, without
+        # keeping them in the view
+        return [[w, self.decode(w, a, b)] for (w, _, a, b) in self.spans[field_number]]
+
+    def __getitem__(self, field_number):
+        entries = self.fields.get(field_number)
+        if entries is None:
+            if field_number in self.removed or field_number not in self.spans:
+                raise KeyError(field_number)
+            entries = [list(entry) for entry in self.original(field_number)]
+            self.fields[field_number] = entries
+        return entries
+
+    def __setitem__(self, field_number, entries):
+        self.fields[field_number] = entries
+        self.removed.discard(field_number)
+        self.drop_children(field_number)
+
+    def __delitem__(self, field_number):
+        if field_number not in self:
+            raise KeyError(field_number)
+        self.fields.pop(field_number, None)
+        self.removed.add(field_number)
+        self.drop_children(field_number)
+
+    def drop_children(self, field_number):
+        # Views from message() are of the entries being replaced, and would
+        # otherwise be written out in place of the new ones
+        for key in [key for key in self.children if key[0] == field_number]:
+            del self.children[key]
+
+    def __contains__(self, field_number):
+        if field_number in self.removed:
+            return False
+        return field_number in self.fields or field_number in self.spans
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return [k for k in set(self.spans) | set(self.fields) if k not in self.removed]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def get(self, field_number, default=None):
+        if field_number not in self:
+            return default
+        return self[field_number]
+
+    def setdefault(self, field_number, default=None):
+        if field_number not in self:
+            self[field_number] = default
+        return self[field_number]
+
+    def raw(self, field_number, index=0):
+        # The original bytes of a value, without copying
+        wire_type, _, start, end = self.spans[field_number][index]
+        return self.view[start: end]
+
+    def message(self, field_number, index=0):
+        # A view of a nested message. Changes to it are written out by
+        # tobytes, and take the place of its entry in the parent once made.
+        child = self.children.get((field_number, index))
+        if child is None:
+            if field_number not in self:
+                raise KeyError(field_number)
+            entries = self.fields.get(field_number)
+            spans = self.spans.get(field_number, [])
+            if entries is not None and (index >= len(spans) or entries[index] != self.original(field_number)[index]):
+                child = MessageView(entries[index][1])
+            else:
+                wire_type, _, start, end = spans[index]
+                child = MessageView(self.data, start, end)
+            self.children[(field_number, index)] = child
+        return child
+
+    def changed(self):
+        changed = set(self.removed)
+        for field_number, entries in self.fields.items():
+            if field_number not in self.spans or entries != self.original(field_number):
+                changed.add(field_number)
+        for (field_number, index), child in self.children.items():
+            if field_number not in self.removed and child.modified():
+                changed.add(field_number)
+        return changed
+
+    def modified(self):
+        return len(self.changed()) != 0
+
+    def encode(self, field_number):
+        # Encodes every entry of a changed field, reusing the bytes of the
+        # entries that are still the same
+        if field_number in self.removed:
+            return ""
+        pieces = []
+        spans = self.spans.get(field_number, [])
+        original = self.original(field_number)
+        entries = self.fields.get(field_number)
+        if entries is None:
+            entries = original
+        for index, entry in enumerate(entries):
+            child = self.children.get((field_number, index))
+            if child is not None and child.modified():
+                pieces.append(write_protobuf({field_number: [[2, child.tobytes()]]}))
+            elif index < len(spans) and entry == original[index]:
+                pieces.append(self.view[spans[index][1]: spans[index][3]].tobytes())
+            else:
+                pieces.append(write_protobuf({field_number: [entry]}))
+        return "".join(pieces)
+
+    def insert_position(self, field_number):
+        starts = [spans[0][1] for (k, spans) in self.spans.items() if k > field_number]
+        return min(starts) if starts else self.end
+
+    def tobytes(self):
+        changed = self.changed()
+        if not changed:
+            if self.start == 0 and self.end == len(self.data) and type(self.data) is str:
+                return self.data
+            return self.view[self.start: self.end].tobytes()
+
+        # Only the spans of changed fields are cut out of the original bytes,
+        # the first span of each taking the field's new encoding. Fields that
+        # are new go before the first field numbered above them, which keeps
+        # the order write_protobuf gives.
+        cuts = []
+        for field_number in changed:
+            encoded = self.encode(field_number)
+            spans = self.spans.get(field_number)
+            if spans is None:
+                start = self.insert_position(field_number)
+                cuts.append((start, start, field_number, encoded))
+                continue
+            for wire_type, start, value_start, end in spans:
+                cuts.append((start, end, field_number, encoded))
+                encoded = ""
+        cuts.sort()
+        pieces = []
+        run = self.start
+        for start, end, field_number, encoded in cuts:
+            pieces.append(self.view[run: start].tobytes())
+            pieces.append(encoded)
+            run = end
+        pieces.append(self.view[run: self.end].tobytes())
+        return "".join(pieces)
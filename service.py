@@ -0,0 +1,180 @@
+import BaseHTTPServer
+import SocketServer
+import binascii
+import json
+import multiprocessing
+import optparse
+import random
+import sys
+import threading
+import urlparse
+from cStringIO import StringIO
+
+from cache import PlayerCache
+from data import modify_save, parse_changes, export_items, import_items
+from error import ERRNO
+from presents import unwrap_player_data, wrap_player_data, use_player_cache
+
+# Paths served and the operation each runs
+endpoints = {
+    "/unwrap": "unwrap", "/wrap": "wrap", "/modify": "modify", "/export": "export", "/import": "import"
+}
+
+
+def work(op, data, params):
+    # Runs in a pool process. data is the request body, a save game for
+    # everything but wrap, which takes a player protobuf.
+    level = int(params.get("level", 1))
+    if op == "unwrap":
+        return unwrap_player_data(data)
+    elif op == "wrap":
+        return wrap_player_data(data, level=level)
+    elif op == "modify":
+        return modify_save(data, parse_changes(params.get("changes", "")), level)
+    elif op == "export":
+        output = StringIO()
+        export_items(data, output)
+        return output.getvalue()
+    elif op == "import":
+        return import_items(data, params["codes"], level)
+    raise ERRNO("Unknown operation " + repr(op))
+
+
+class ServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Each request gets a thread, which waits on a bounded process pool for
+    # the codec work. Once the pool and its queue are full, requests are
+    # turned away with 503 rather than piling up.
+
+    daemon_threads = True
+
+    def __init__(self, address, processes=0, queue=None):
+        if processes == 0:
+            processes = multiprocessing.cpu_count()
+        if queue is None:
+            queue = processes * 2
+        # The pool is forked before the socket is opened so that the workers
+        # don't hold it
+        self.pool = multiprocessing.Pool(processes, random.seed)
+        BaseHTTPServer.HTTPServer.__init__(self, address, ServiceHandler)
+        self.processes = processes
+        self.queue = queue
+        self.slots = threading.BoundedSemaphore(processes + queue)
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.verbose = False
+
+    def run(self, op, data, params):
+        # Returns the result of work, or None when the service is full
+        if not self.slots.acquire(False):
+            return None
+        with self.lock:
+            self.busy = self.busy + 1
+        try:
+            return self.pool.apply(work, (op, data, params))
+        finally:
+            with self.lock:
+                self.busy = self.busy - 1
+            self.slots.release()
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # POST /unwrap, /wrap, /modify and /export take the save game, or for
+    # wrap the player, as the body, with level and changes as query
+    # parameters. POST /import takes a JSON body of the save game in base64
+    # as "save" and the item codes as "codes". GET /status reports the load.
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if urlparse.urlparse(self.path).path != "/status":
+            return self.reply(404, "Unknown path " + self.path)
+        server = self.server
+        status = {"processes": server.processes, "queue": server.queue, "busy": server.busy}
+        self.reply(200, json.dumps(status), "application/json")
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        op = endpoints.get(url.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if op is None:
+            return self.reply(404, "Unknown path " + url.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        try:
+            if op == "import":
+                request = json.loads(body)
+                body = request["save"].decode("base64")
+                params["codes"] = request["codes"]
+            result = self.server.run(op, body, params)
+        except (ERRNO, ValueError, KeyError, binascii.Error) as e:
+            return self.reply(400, "%s: %s" % (type(e).__name__, e))
+        except Exception as e:
+            return self.reply(500, "%s: %s" % (type(e).__name__, e))
+        if result is None:
+            return self.reply(503, "Service is busy, try again later", headers={"Retry-After": "1"})
+        self.reply(200, result)
+
+    def reply(self, code, body, content_type="application/octet-stream", headers={}):
+        if code != 200:
+            content_type = "text/plain"
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def main():
+    p = optparse.OptionParser()
+    p.add_option(
+        "-H", "--host", default="127.0.0.1",
+        help="address to listen on, localhost by default"
+    )
+    p.add_option(
+        "-p", "--port", type="int", default=8642,
+        help="port to listen on"
+    )
+    p.add_option(
+        "-c", "--cache", metavar="DIRECTORY",
+        help="keep decoded saves in a directory and reuse them while the save is unchanged"
+    )
+    p.add_option(
+        "--jobs", metavar="N", type="int", default=0,
+        help="number of worker processes, 0 for one per CPU"
+    )
+    p.add_option(
+        "-q", "--queue", type="int",
+        help="number of requests to queue once every worker is busy, twice the workers by default"
+    )
+    p.add_option(
+        "-v", "--verbose", action="store_true",
+        help="log every request"
+    )
+    options, args = p.parse_args()
+    if options.cache:
+        use_player_cache(PlayerCache(options.cache))
+    server = ServiceServer((options.host, options.port), options.jobs, options.queue)
+    server.verbose = options.verbose
+    print >> sys.stderr, "Listening on http://%s:%d/ with %d processes" % (
+        server.server_address[0], server.server_address[1], server.processes
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
-from bisect import insort
+from heapq import heapify, heappop, heappush
+from struct import unpack_from
+
+DECODE_TABLE_BITS = 10
+MAX_CODE_LENGTH = 24
 
 
 def read_huffman_tree(b):
@@ -19,46 +23,140 @@ def write_huffman_tree(node, b):
         write_huffman_tree(node[1][1], b)
 
 
-def make_huffman_tree(data):
+def count_frequencies(data):
     frequencies = [0] * 256
-    for c in data:
-        frequencies[ord(c)] += 1
+    for c in bytearray(data):
+        frequencies[c] += 1
+    return frequencies
 
-    nodes = [[f, i] for (i, f) in enumerate(frequencies) if f != 0]
-    nodes.sort()
 
-    while len(nodes) > 1:
-        l, r = nodes[: 2]
-        nodes = nodes[2:]
-        insort(nodes, [l[0] + r[0], [l, r]])
+def make_huffman_tree(data, frequencies=None):
+    if frequencies is None:
+        frequencies = count_frequencies(data)
+    else:
+        # A histogram from an earlier save must still cover every byte here
+        frequencies = list(frequencies)
+        for c in set(data):
+            if frequencies[ord(c)] == 0:
+                frequencies[ord(c)] = 1
 
-    return nodes[0]
+    symbols = [i for (i, f) in enumerate(frequencies) if f != 0]
+    # The decoder needs at least one bit per symbol, so pad out to two leaves
+    for i in xrange(256):
+        if len(symbols) >= 2:
+            break
+        if i not in symbols:
+            symbols.append(i)
 
+    scale = 0
+    while 1:
+        tree = build_huffman_tree([(frequencies[i] >> scale or 1, i) for i in symbols])
+        if tree_depth(tree) <= MAX_CODE_LENGTH:
+            return tree
+        scale = scale + 1
 
-def invert_tree(node, code=0, bits=0):
-    if type(node[1]) is int:
-        return {chr(node[1]): (code, bits)}
-    else:
-        d = {}
-        d.update(invert_tree(node[1][0], code << 1, bits + 1))
-        d.update(invert_tree(node[1][1], (code << 1) | 1, bits + 1))
-        return d
+
+def build_huffman_tree(weights):
+    # Entries carry an insertion counter so equal weights never compare nodes
+    heap = [(f, i, [f, i]) for (f, i) in weights]
+    heapify(heap)
+    order = 256
+    while len(heap) > 1:
+        lf, _, l = heappop(heap)
+        rf, _, r = heappop(heap)
+        heappush(heap, (lf + rf, order, [lf + rf, [l, r]]))
+        order = order + 1
+    return heap[0][2]
+
+
+def make_encode_table(tree):
+    table = [None] * 256
+    stack = [(tree, 0, 0)]
+    while stack:
+        node, code, bits = stack.pop()
+        if type(node[1]) is int:
+            table[node[1]] = (code, bits)
+        else:
+            stack.append((node[1][0], code << 1, bits + 1))
+            stack.append((node[1][1], (code << 1) | 1, bits + 1))
+    return table
+
+
+def tree_depth(node):
+    depth = 0
+    stack = [(node, 0)]
+    while stack:
+        node, bits = stack.pop()
+        if type(node[1]) is int:
+            depth = max(depth, bits)
+        else:
+            stack.append((node[1][0], bits + 1))
+            stack.append((node[1][1], bits + 1))
+    return depth
+
+
+def make_decode_table(node, table_bits=DECODE_TABLE_BITS):
+    # Every entry of a table is indexed by the next `bits` bits of the stream.
+    # Leaves are stored as (symbol, code length), codes longer than the table
+    # as (-1, (subtable, subtable bits)) keyed by their first `bits` bits.
+    bits = max(1, min(table_bits, tree_depth(node)))
+    table = [None] * (1 << bits)
+    stack = [(node, 0, 0)]
+    while stack:
+        node, code, depth = stack.pop()
+        if type(node[1]) is int:
+            shift = bits - depth
+            start = code << shift
+            table[start: start + (1 << shift)] = [(node[1], depth)] * (1 << shift)
+        elif depth == bits:
+            table[code] = (-1, make_decode_table(node, table_bits))
+        else:
+            stack.append((node[1][0], code << 1, depth + 1))
+            stack.append((node[1][1], (code << 1) | 1, depth + 1))
+    return table, bits
 
 
 def huffman_decompress(tree, bitstream, size):
-    output = ""
-    while len(output) < size:
-        node = tree
-        while 1:
-            b = bitstream.read_bit()
-            node = node[1][b]
-            if type(node[1]) is int:
-                output += chr(node[1])
-                break
-    return output
+    root, root_bits = make_decode_table(tree)
+    root_mask = (1 << root_bits) - 1
+    view = bitstream.view
+    last_word = bitstream.size - 4
+    output = bytearray(size)
+
+    # The bitstream state is kept in locals and refilled inline a word at a
+    # time; the tail of the data and codes longer than the root table are
+    # left to the bitstream's own refill, peek and consume.
+    acc, nacc, pos = bitstream.acc, bitstream.nacc, bitstream.pos
+    for o in xrange(size):
+        if nacc <= 24:
+            if pos <= last_word:
+                acc = ((acc & ((1 << nacc) - 1)) << 32) | unpack_from(">I", view, pos)[0]
+                nacc = nacc + 32
+                pos = pos + 4
+            else:
+                bitstream.acc, bitstream.nacc, bitstream.pos = acc, nacc, pos
+                bitstream.refill()
+                acc, nacc, pos = bitstream.acc, bitstream.nacc, bitstream.pos
+        symbol, n = root[(acc >> (nacc - root_bits)) & root_mask]
+        if symbol < 0:
+            bitstream.acc, bitstream.nacc, bitstream.pos = acc, nacc - root_bits, pos
+            table, bits = n
+            symbol, n = table[bitstream.peek(bits)]
+            while symbol < 0:
+                bitstream.consume(bits)
+                table, bits = n
+                symbol, n = table[bitstream.peek(bits)]
+            acc, nacc, pos = bitstream.acc, bitstream.nacc, bitstream.pos
+        nacc = nacc - n
+        output[o] = symbol
+
+    bitstream.acc, bitstream.nacc, bitstream.pos = acc, nacc, pos
+    bitstream.consume(0)
+    return str(output)
 
 
 def huffman_compress(encoding, data, bitstream):
-    for c in data:
+    write_bits = bitstream.write_bits
+    for c in bytearray(data):
         code, nbits = encoding[c]
-        bitstream.write_bits(code, nbits)
+        write_bits(code, nbits)
@@ -7,76 +7,85 @@ from error import ERRNO
 class WriteBitstream(object):
 
     def __init__(self):
-        self.s = ""
-        self.byte = 0
-        self.i = 7
+        self.buffer = bytearray()
+        self.acc = 0
+        self.nacc = 0
+        # Set while the last byte of buffer is a padded copy of acc
+        self.tail = False
 
     def write_bit(self, b):
-        i = self.i
-        byte = self.byte | (b << i)
-        if i == 0:
-            self.s += chr(byte)
-            self.byte = 0
-            self.i = 7
-        else:
-            self.byte = byte
-            self.i = i - 1
+        self.write_bits(b, 1)
 
     def write_bits(self, b, n):
-        s = self.s
-        byte = self.byte
-        i = self.i
-        while n >= (i + 1):
-            shift = n - (i + 1)
-            n = n - (i + 1)
-            byte = byte | (b >> shift)
-            b = b & ~ (byte << shift)
-            s = s + chr(byte)
-            byte = 0
-            i = 7
-        if n > 0:
-            byte = byte | (b << (i + 1 - n))
-            i = i - n
-        self.s = s
-        self.byte = byte
-        self.i = i
+        acc = (self.acc << n) | b
+        nacc = self.nacc + n
+        if nacc >= 32:
+            buffer = self.buffer
+            if self.tail:
+                del buffer[-1]
+                self.tail = False
+            while nacc >= 32:
+                nacc = nacc - 32
+                buffer += struct.pack(">I", (acc >> nacc) & 0xffffffff)
+            acc = acc & ((1 << nacc) - 1)
+        self.acc = acc
+        self.nacc = nacc
 
     def write_byte(self, b):
-        i = self.i
-        if i == 7:
-            self.s += chr(b)
-        else:
-            self.s += chr(self.byte | (b >> (7 - i)))
-            self.byte = (b << (i + 1)) & 0xff
+        self.write_bits(b, 8)
 
     def getvalue(self):
-        if self.i != 7:
-            return self.s + chr(self.byte)
-        else:
-            return self.s
+        # Returns the live buffer, padded out to a whole byte, without copying
+        buffer = self.buffer
+        if self.tail:
+            del buffer[-1]
+            self.tail = False
+        acc = self.acc
+        nacc = self.nacc
+        while nacc >= 8:
+            nacc = nacc - 8
+            buffer.append((acc >> nacc) & 0xff)
+        acc = acc & ((1 << nacc) - 1)
+        if nacc != 0:
+            buffer.append((acc << (8 - nacc)) & 0xff)
+            self.tail = True
+        self.acc = acc
+        self.nacc = nacc
+        return buffer
 
 
 def write_varint(f, i):
+    if i <= 0x7f:
+        f.write(chr(i))
+    else:
+        f.write(encode_varint(i))
+
+
+def encode_varint(i):
+    if i <= 0x7f:
+        return chr(i)
+    b = bytearray()
     while i > 0x7f:
-        f.write(chr(0x80 | (i & 0x7f)))
+        b.append(0x80 | (i & 0x7f))
         i = i >> 7
-    f.write(chr(i))
+    b.append(i)
+    return str(b)
 
 
 def write_protobuf(data):
+    if hasattr(data, "tobytes"):
+        # A MessageView only encodes the fields changed since it was read
+        return data.tobytes()
     b = StringIO()
     # If the data came from a JSON file the keys will all be strings
     data = dict([(int(k), v) for (k, v) in data.items()])
     for key, entries in sorted(data.items()):
         for wire_type, value in entries:
-            if type(value) is dict:
+            if type(value) is dict or hasattr(value, "tobytes"):
                 value = write_protobuf(value)
                 wire_type = 2
             elif type(value) in (list, tuple) and wire_type != 2:
-                sub_b = StringIO()
-                for v in value:
-                    write_protobuf_value(sub_b, wire_type, v)
-                value = sub_b.getvalue()
+                value = encode_packed(value, wire_type)
                 wire_type = 2
             write_varint(b, (key << 3) | wire_type)
             write_protobuf_value(b, wire_type, value)
@@ -102,7 +111,20 @@ def write_protobuf_value(b, wire_type, value):
 
 
 def write_repeated_protobuf_value(data, wire_type):
+    return encode_packed(data, wire_type)
+
+
+def encode_packed(values, wire_type):
+    # Encodes the values of a packed repeated field in one go
+    if wire_type == 0:
+        if len(values) != 0 and min(values) >= 0 and max(values) <= 0x7f:
+            return str(bytearray(values))
+        return "".join(map(encode_varint, values))
+    elif wire_type == 1:
+        return struct.pack("<%dQ" % len(values), *values)
+    elif wire_type == 5:
+        return struct.pack("<%dI" % len(values), *values)
     b = StringIO()
-    for value in data:
+    for value in values:
         write_protobuf_value(b, wire_type, value)
     return b.getvalue()